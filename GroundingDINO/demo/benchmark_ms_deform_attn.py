@@ -0,0 +1,92 @@
+"""
+Compares the multi-scale deformable attention implementations on CPU: the per-level
+grid_sample reference, the gather-based PyTorch path and the C++ kernel of groundingdino._C.
+Reports the max abs difference to the reference and the mean time per call.
+
+    python demo/benchmark_ms_deform_attn.py --threads 8
+"""
+import argparse
+import time
+
+import torch
+
+from groundingdino.models.GroundingDINO import ms_deform_attn
+from groundingdino.models.GroundingDINO.ms_deform_attn import (
+    multi_scale_deformable_attn_gather,
+    multi_scale_deformable_attn_pytorch,
+)
+
+
+def make_inputs(num_queries, num_heads, embed_dims, spatial_shapes, num_points, dtype, bs=1, margin=0.1):
+    """
+    Random MSDeformAttn inputs. Sampling locations are drawn from [-margin, 1 + margin],
+    so with margin > 0 some points fall partly or fully outside the feature map and
+    exercise the zero padding.
+    """
+    spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long)
+    level_start_index = torch.cat(
+        (spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1])
+    )
+    num_value = int(spatial_shapes.prod(1).sum())
+    num_levels = len(spatial_shapes)
+    value = torch.randn(bs, num_value, num_heads, embed_dims, dtype=dtype)
+    sampling_locations = (
+        torch.rand(bs, num_queries, num_heads, num_levels, num_points, 2, dtype=dtype) * (1 + 2 * margin) - margin
+    )
+    attention_weights = (
+        torch.rand(bs, num_queries, num_heads, num_levels * num_points, dtype=dtype)
+        .softmax(-1)
+        .view(bs, num_queries, num_heads, num_levels, num_points)
+    )
+    return value, spatial_shapes, level_start_index, sampling_locations, attention_weights
+
+
+def benchmark(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("MSDeformAttn CPU benchmark", add_help=True)
+    parser.add_argument("--queries", type=int, default=0, help="number of queries, default: one per value (encoder)")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, default: torch default")
+    parser.add_argument("--repeats", type=int, default=5, help="timed calls per implementation")
+    parser.add_argument("--double", action="store_true", help="run in float64")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    # 800 x 800 input: strides 8, 16, 32 and the extra level 64
+    spatial_shapes = [(100, 100), (50, 50), (25, 25), (13, 13)]
+    num_queries = args.queries or sum(h * w for h, w in spatial_shapes)
+    dtype = torch.float64 if args.double else torch.float32
+    value, spatial_shapes, level_start_index, sampling_locations, attention_weights = make_inputs(
+        num_queries, 8, 32, spatial_shapes, 4, dtype
+    )
+
+    implementations = {
+        "pytorch": lambda: multi_scale_deformable_attn_pytorch(
+            value, spatial_shapes, sampling_locations, attention_weights
+        ),
+        "gather": lambda: multi_scale_deformable_attn_gather(
+            value, spatial_shapes, level_start_index, sampling_locations, attention_weights
+        ),
+    }
+    if ms_deform_attn._HAS_CPU_KERNEL:
+        implementations["cpp"] = lambda: ms_deform_attn._C.ms_deform_attn_cpu_forward(
+            value, spatial_shapes, level_start_index, sampling_locations, attention_weights, 64
+        )
+    else:
+        print("groundingdino._C has no CPU kernel, rebuild with `pip install -e .` to include it")
+
+    print(f"queries {num_queries}, threads {torch.get_num_threads()}, {dtype}")
+    with torch.no_grad():
+        reference = implementations["pytorch"]()
+        for name, fn in implementations.items():
+            max_diff = (fn() - reference).abs().max().item()
+            seconds = benchmark(fn, args.repeats)
+            print(f"{name:>8}: {seconds * 1000:8.1f} ms/call, max abs diff {max_diff:.2e}")
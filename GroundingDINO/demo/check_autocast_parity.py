@@ -0,0 +1,134 @@
+"""
+Checks that inference.Model(precision="bf16" / "fp16") stays close to precision="fp32",
+on --checkpoint_path or, without one, on a randomly initialized model (which only needs
+the text encoder of the config, or --text_encoder_type). Both models get the same weights
+and run predict_batch_with_classes on the same images, keeping every query (box_threshold 0).
+Exits non-zero when a tolerance is exceeded.
+
+Three things are compared, nothing of the autocast model is replaced by fp32 values:
+- the encoder logits (the output of transformer.enc_out_class_embed, an fp32 island);
+- the two-stage top-k selection: in every query slot, the proposal picked under autocast
+  must have an fp32 score within the encoder tolerance of the one fp32 picked, i.e. the two
+  selections may only differ by swapping near ties, which an untrained model has plenty of;
+- the decoder outputs (pred_boxes, pred_logits) of the slots holding the same proposal in
+  both models. Swapped slots start from another proposal, so they are not compared.
+
+Without a checkpoint, the zero-initialized last layer of the box heads (an untrained model
+returns its anchors as boxes) gets small random weights so the boxes depend on the decoder.
+
+    python demo/check_autocast_parity.py -c groundingdino/config/GroundingDINO_SwinT_OGC.py -p weights/groundingdino_swint_ogc.pth
+    python demo/check_autocast_parity.py -c groundingdino/config/GroundingDINO_SwinT_OGC.py -p weights/groundingdino_swint_ogc.pth --precision fp16
+    python demo/check_autocast_parity.py -c groundingdino/config/GroundingDINO_SwinT_OGC.py --device cuda --precision fp16
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from groundingdino.util.inference import Model
+from random_model import build_random_model
+
+CLASSES = ["cat", "dog", "red car", "person"]
+# the logit tolerances are a number of rounding units (unit roundoff of the format) of the
+# largest fp32 logit: the logits themselves are computed in fp32, but from features that
+# went through the 6 encoder layers (and the 6 decoder layers) in bf16 / fp16, each adding
+# about one rounding error. They are provisional: this check has not been run on a trained
+# checkpoint yet (the only measurement, on random weights with a pinned top-k, was about
+# 4.5 units on the decoder logits), so the observed max diffs should replace them.
+UNIT_ROUNDOFF = {"bf16": 2.0 ** -8, "fp16": 2.0 ** -11}
+ENCODER_LOGIT_UNITS = 4
+DECODER_LOGIT_UNITS = 8
+
+
+def perturb_box_heads(model):
+    torch.manual_seed(1)
+    for bbox_embed in list(model.bbox_embed) + [model.transformer.enc_out_bbox_embed]:
+        torch.nn.init.normal_(bbox_embed.layers[-1].weight, std=0.01)
+
+
+def record_outputs(model):
+    """Records the encoder logits and the decoder outputs of every forward of model, unchanged."""
+    recorded = {"encoder_logits": [], "outputs": []}
+
+    def record_encoder_logits(module, inputs, output):
+        recorded["encoder_logits"].append(output.detach().float().cpu())
+
+    def record_decoder_outputs(module, inputs, output):
+        recorded["outputs"].append({key: output[key].detach().float().cpu() for key in ("pred_logits", "pred_boxes")})
+
+    model.transformer.enc_out_class_embed.register_forward_hook(record_encoder_logits)
+    model.register_forward_hook(record_decoder_outputs)
+    return recorded
+
+
+def run(model, recorded, images):
+    for values in recorded.values():
+        values.clear()
+    model.predict_batch_with_classes(images, CLASSES, box_threshold=0.0, text_threshold=0.25)
+    # the first enc_out_class_embed call of the forward, in case it is shared with the decoder
+    encoder_logits = recorded["encoder_logits"][0]
+    proposals = torch.topk(encoder_logits.max(-1)[0], model.model.num_queries, dim=1)[1]
+    return encoder_logits, proposals, recorded["outputs"][0]
+
+
+def max_finite_diff(a, b):
+    """Max abs difference of a and b where a is finite (masked text tokens are -inf in both)."""
+    finite = torch.isfinite(a)
+    assert torch.equal(finite, torch.isfinite(b)), "different masked logits"
+    return (a[finite] - b[finite]).abs().max().item(), a[finite].abs().max().item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("autocast parity check", add_help=True)
+    parser.add_argument("--config_file", "-c", type=str, required=True, help="path to config file")
+    parser.add_argument("--checkpoint_path", "-p", type=str, default="", help="checkpoint, random weights if not set")
+    parser.add_argument("--text_encoder_type", type=str, default="", help="override the config's text encoder")
+    parser.add_argument("--device", type=str, default="cpu", help="device to run on")
+    parser.add_argument("--precision", type=str, default="bf16", choices=["bf16", "fp16"])
+    parser.add_argument("--box_atol", type=float, default=1e-2, help="max abs difference of normalized box coordinates")
+    args = parser.parse_args()
+    unit = UNIT_ROUNDOFF[args.precision]
+
+    if args.checkpoint_path:
+        models = [
+            Model(args.config_file, args.checkpoint_path, device=args.device, precision=precision)
+            for precision in ("fp32", args.precision)
+        ]
+    else:
+        models = [
+            build_random_model(args.config_file, args.text_encoder_type, args.device, precision=precision)
+            for precision in ("fp32", args.precision)
+        ]
+        for model in models:
+            perturb_box_heads(model.model)
+    recorded = [record_outputs(model.model) for model in models]
+
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (320, 480, 3), dtype=np.uint8), rng.integers(0, 256, (288, 416, 3), dtype=np.uint8)]
+    with torch.no_grad():
+        encoder_logits, proposals, outputs = run(models[0], recorded[0], images)
+        autocast_encoder_logits, autocast_proposals, autocast_outputs = run(models[1], recorded[1], images)
+
+    # encoder logits
+    encoder_diff, encoder_scale = max_finite_diff(encoder_logits, autocast_encoder_logits)
+    encoder_atol = ENCODER_LOGIT_UNITS * unit * encoder_scale
+    print(f"{args.precision} vs fp32: encoder logits max abs diff {encoder_diff:.2e} (max |logit| {encoder_scale:.1f})")
+    assert encoder_diff <= encoder_atol, f"encoder logits differ by more than {encoder_atol:.2e}"
+
+    # two-stage top-k selection
+    scores = encoder_logits.max(-1)[0]
+    selection_diff = (scores.gather(1, autocast_proposals) - scores.gather(1, proposals)).abs().max().item()
+    same_slots = autocast_proposals == proposals
+    print(f"{args.precision} vs fp32: {(~same_slots).sum().item()} of {same_slots.numel()} query slots hold another "
+          f"proposal, fp32 scores of the swapped proposals differ by up to {selection_diff:.2e}")
+    assert selection_diff <= encoder_atol, f"top-k selection differs beyond near ties ({encoder_atol:.2e})"
+
+    # decoder outputs of the slots decoded from the same proposal
+    box_diff = (autocast_outputs["pred_boxes"] - outputs["pred_boxes"])[same_slots].abs().max().item()
+    logit_diff, logit_scale = max_finite_diff(outputs["pred_logits"][same_slots], autocast_outputs["pred_logits"][same_slots])
+    logit_atol = DECODER_LOGIT_UNITS * unit * logit_scale
+    print(f"{args.precision} vs fp32: max abs diff boxes {box_diff:.2e}, "
+          f"logits {logit_diff:.2e} (max |logit| {logit_scale:.1f}) over {same_slots.sum().item()} queries")
+    assert box_diff <= args.box_atol, f"boxes differ by more than {args.box_atol}"
+    assert logit_diff <= logit_atol, f"decoder logits differ by more than {logit_atol:.2e}"
+    print("ok")
@@ -0,0 +1,66 @@
+"""
+Checks the gather-based multi-scale deformable attention (and the C++ CPU kernel, when
+groundingdino._C has it) against the per-level grid_sample reference, in float64: the
+outputs, and for the gather path the gradients w.r.t. value, sampling locations and
+attention weights. Sampling locations are drawn from [-0.25, 1.25], so some points fall
+partly or fully outside the feature map and exercise the zero padding.
+
+    python demo/check_ms_deform_attn.py
+"""
+import argparse
+
+import torch
+
+from benchmark_ms_deform_attn import make_inputs
+from groundingdino.models.GroundingDINO import ms_deform_attn
+from groundingdino.models.GroundingDINO.ms_deform_attn import (
+    multi_scale_deformable_attn_gather,
+    multi_scale_deformable_attn_pytorch,
+)
+
+
+def outputs_and_grads(fn, value, sampling_locations, attention_weights, grad_output):
+    inputs = [t.clone().requires_grad_() for t in (value, sampling_locations, attention_weights)]
+    output = fn(*inputs)
+    output.backward(grad_output)
+    return output.detach(), [t.grad for t in inputs]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("MSDeformAttn parity check", add_help=True)
+    parser.add_argument("--atol", type=float, default=1e-10, help="max abs difference to the reference")
+    parser.add_argument("--seeds", type=int, default=5, help="number of random inputs")
+    args = parser.parse_args()
+
+    # includes 1-pixel levels and levels narrower than they are tall
+    spatial_shapes = [(17, 23), (9, 12), (5, 6), (1, 3), (1, 1)]
+    for seed in range(args.seeds):
+        torch.manual_seed(seed)
+        value, spatial_shapes_t, level_start_index, sampling_locations, attention_weights = make_inputs(
+            31, 4, 8, spatial_shapes, 4, torch.float64, bs=2, margin=0.25
+        )
+        grad_output = torch.randn(2, 31, 4 * 8, dtype=torch.float64)
+
+        reference, reference_grads = outputs_and_grads(
+            lambda v, s, a: multi_scale_deformable_attn_pytorch(v, spatial_shapes_t, s, a),
+            value, sampling_locations, attention_weights, grad_output,
+        )
+        output, grads = outputs_and_grads(
+            lambda v, s, a: multi_scale_deformable_attn_gather(v, spatial_shapes_t, level_start_index, s, a),
+            value, sampling_locations, attention_weights, grad_output,
+        )
+        max_diff = (output - reference).abs().max().item()
+        assert max_diff <= args.atol, f"seed {seed}: gather output differs by {max_diff:.2e}"
+        for name, grad, reference_grad in zip(
+            ("value", "sampling_locations", "attention_weights"), grads, reference_grads
+        ):
+            grad_diff = (grad - reference_grad).abs().max().item()
+            assert grad_diff <= args.atol, f"seed {seed}: gather grad of {name} differs by {grad_diff:.2e}"
+
+        if ms_deform_attn._HAS_CPU_KERNEL:
+            output = ms_deform_attn._C.ms_deform_attn_cpu_forward(
+                value, spatial_shapes_t, level_start_index, sampling_locations, attention_weights, 64
+            )
+            cpp_diff = (output - reference).abs().max().item()
+            assert cpp_diff <= args.atol, f"seed {seed}: cpp output differs by {cpp_diff:.2e}"
+    print(f"ok ({args.seeds} inputs{', with the cpp kernel' if ms_deform_attn._HAS_CPU_KERNEL else ''})")
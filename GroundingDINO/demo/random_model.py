@@ -0,0 +1,31 @@
+"""
+Random-weight inference.Model for the demo checks, so they need no checkpoint (only the
+text encoder of the config, or a text_encoder_type override).
+"""
+import os
+import tempfile
+
+import torch
+
+from groundingdino.models import build_model
+from groundingdino.util.inference import Model
+from groundingdino.util.slconfig import SLConfig
+
+
+def build_random_model(config_file, text_encoder_type, device, seed=0, **model_kwargs):
+    """Model with the weights of a freshly built (untrained) GroundingDINO, the same for a given seed."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = os.path.join(tmp_dir, "config.py")
+        checkpoint_path = os.path.join(tmp_dir, "checkpoint.pth")
+        with open(config_file) as f:
+            config = f.read()
+        if text_encoder_type:
+            config += f"\ntext_encoder_type = {text_encoder_type!r}\n"
+        with open(config_path, "w") as f:
+            f.write(config)
+
+        args = SLConfig.fromfile(config_path)
+        args.device = "cpu"
+        torch.manual_seed(seed)
+        torch.save({"model": build_model(args).state_dict()}, checkpoint_path)
+        return Model(config_path, checkpoint_path, device=device, **model_kwargs)
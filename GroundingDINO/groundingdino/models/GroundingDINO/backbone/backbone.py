@@ -152,6 +152,9 @@ class Joiner(nn.Sequential):
         out: List[NestedTensor] = []
         pos = []
         for name, x in xs.items():
+            # the feature masks are downsampled from the input mask, so they are unpadded
+            # whenever it is
+            x.unpadded = tensor_list.unpadded
             out.append(x)
             # position encoding
             pos.append(self[1](x).to(x.tensors.dtype))
@@ -24,10 +24,45 @@ import math
 import torch
 from torch import nn
 
-from groundingdino.util.misc import NestedTensor
+from groundingdino.util.misc import LRUCache, NestedTensor
 
+# number of (h, w, device) sine embeddings kept per module
+POSITION_EMBEDDING_CACHE_SIZE = 32
 
-class PositionEmbeddingSine(nn.Module):
+
+class MemoizedPositionEmbedding(nn.Module):
+    """
+    Base class for position embeddings that only depend on the mask.
+
+    Without padding the embedding of every image is the same and depends only on the
+    feature map size, so it is computed once per (h, w, device) and expanded over the
+    batch. Whether there is padding is taken from NestedTensor.unpadded, which is known on
+    the host, rather than from the mask, which would need a device sync per level; masks
+    that are padded or not known to be unpadded fall back to computing it. Subclasses
+    implement embed(mask).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._cache = LRUCache(POSITION_EMBEDDING_CACHE_SIZE)
+
+    def embed(self, mask):
+        raise NotImplementedError
+
+    def forward(self, tensor_list: NestedTensor):
+        mask = tensor_list.mask
+        assert mask is not None
+        if not tensor_list.unpadded:
+            return self.embed(mask)
+
+        key = (mask.shape[1], mask.shape[2], mask.device)
+        pos = self._cache.get(key)
+        if pos is None:
+            pos = self._cache.put(key, self.embed(mask[:1]))
+        return pos.expand(mask.shape[0], -1, -1, -1)
+
+
+class PositionEmbeddingSine(MemoizedPositionEmbedding):
     """
     This is a more standard version of the position embedding, very similar to the one
     used by the Attention is all you need paper, generalized to work on images.
@@ -44,10 +79,7 @@ class PositionEmbeddingSine(nn.Module):
             scale = 2 * math.pi
         self.scale = scale
 
-    def forward(self, tensor_list: NestedTensor):
-        x = tensor_list.tensors
-        mask = tensor_list.mask
-        assert mask is not None
+    def embed(self, mask):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -60,7 +92,7 @@ class PositionEmbeddingSine(nn.Module):
             y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
 
         pos_x = x_embed[:, :, :, None] / dim_t
@@ -75,7 +107,7 @@ class PositionEmbeddingSine(nn.Module):
         return pos
 
 
-class PositionEmbeddingSineHW(nn.Module):
+class PositionEmbeddingSineHW(MemoizedPositionEmbedding):
     """
     This is a more standard version of the position embedding, very similar to the one
     used by the Attention is all you need paper, generalized to work on images.
@@ -95,10 +127,7 @@ class PositionEmbeddingSineHW(nn.Module):
             scale = 2 * math.pi
         self.scale = scale
 
-    def forward(self, tensor_list: NestedTensor):
-        x = tensor_list.tensors
-        mask = tensor_list.mask
-        assert mask is not None
+    def embed(self, mask):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -110,11 +139,11 @@ class PositionEmbeddingSineHW(nn.Module):
             y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_tx = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_tx = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_tx = self.temperatureW ** (2 * (torch.div(dim_tx, 2, rounding_mode='floor')) / self.num_pos_feats)
         pos_x = x_embed[:, :, :, None] / dim_tx
 
-        dim_ty = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_ty = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_ty = self.temperatureH ** (2 * (torch.div(dim_ty, 2, rounding_mode='floor')) / self.num_pos_feats)
         pos_y = y_embed[:, :, :, None] / dim_ty
 
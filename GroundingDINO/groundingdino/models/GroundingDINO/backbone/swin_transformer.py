@@ -18,7 +18,10 @@ import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
-from groundingdino.util.misc import NestedTensor
+from groundingdino.util.misc import LRUCache, NestedTensor, is_compiling
+
+# number of padded input resolutions whose SW-MSA attention masks are kept, per stage
+ATTN_MASK_CACHE_SIZE = 32
 
 
 class Mlp(nn.Module):
@@ -340,6 +343,37 @@ class PatchMerging(nn.Module):
         return x
 
 
+def shifted_window_attn_mask(Hp, Wp, window_size, shift_size, device):
+    """Attention mask for SW-MSA on a padded Hp x Wp map.
+    Returns:
+        attn_mask: (nW, window_size*window_size, window_size*window_size)
+    """
+    img_mask = torch.zeros((1, Hp, Wp, 1), device=device)  # 1 Hp Wp 1
+    h_slices = (
+        slice(0, -window_size),
+        slice(-window_size, -shift_size),
+        slice(-shift_size, None),
+    )
+    w_slices = (
+        slice(0, -window_size),
+        slice(-window_size, -shift_size),
+        slice(-shift_size, None),
+    )
+    cnt = 0
+    for h in h_slices:
+        for w in w_slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
+        attn_mask == 0, float(0.0)
+    )
+    return attn_mask
+
+
 class BasicLayer(nn.Module):
     """A basic Swin Transformer layer for one stage.
     Args:
@@ -406,6 +440,23 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
+        # (Hp, Wp, device) -> SW-MSA attention mask, see get_attn_mask
+        self._attn_masks = LRUCache(ATTN_MASK_CACHE_SIZE)
+
+    def get_attn_mask(self, Hp, Wp, device):
+        """shifted_window_attn_mask of this stage, built once per padded resolution and device
+        and shared between calls."""
+        if is_compiling():
+            # traced into the compiled graph once per shape, keep the cache out of it
+            return shifted_window_attn_mask(Hp, Wp, self.window_size, self.shift_size, device)
+        key = (Hp, Wp, device)
+        attn_mask = self._attn_masks.get(key)
+        if attn_mask is None:
+            attn_mask = self._attn_masks.put(
+                key, shifted_window_attn_mask(Hp, Wp, self.window_size, self.shift_size, device)
+            )
+        return attn_mask
+
     def forward(self, x, H, W):
         """Forward function.
         Args:
@@ -416,31 +467,7 @@ class BasicLayer(nn.Module):
         # calculate attention mask for SW-MSA
         Hp = int(np.ceil(H / self.window_size)) * self.window_size
         Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
-        h_slices = (
-            slice(0, -self.window_size),
-            slice(-self.window_size, -self.shift_size),
-            slice(-self.shift_size, None),
-        )
-        w_slices = (
-            slice(0, -self.window_size),
-            slice(-self.window_size, -self.shift_size),
-            slice(-self.shift_size, None),
-        )
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(
-            img_mask, self.window_size
-        )  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
-            attn_mask == 0, float(0.0)
-        )
+        attn_mask = self.get_attn_mask(Hp, Wp, x.device)
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
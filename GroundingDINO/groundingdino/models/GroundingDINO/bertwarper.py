@@ -177,42 +177,72 @@ class TextEncoderShell(nn.Module):
         return self.text_encoder(**kw)
 
 
-def generate_masks_with_special_tokens(tokenized, special_tokens_list, tokenizer):
-    """Generate attention mask between each pair of special tokens
+def _special_token_segments(input_ids, special_tokens_list):
+    """Assigns every token to the phrase closed by the next special token of its row.
+
+    A special token at column col closes the segment (previous_col, col], where previous_col is
+    the column of the special token before it (in row-major order, 0 for the first one).
+    Special tokens in the first or last column only attend to themselves.
     Args:
         input_ids (torch.Tensor): input ids. Shape: [bs, num_token]
-        special_tokens_mask (list): special tokens mask.
+        special_tokens_list (list): ids of the special tokens.
     Returns:
-        torch.Tensor: attention mask between each special tokens.
+        segment_ids (torch.Tensor): [bs, num_token], index of the closing special token
+            in torch.nonzero(special_tokens_mask) order, -1 for tokens outside any segment.
+        position_ids (torch.Tensor): [bs, num_token], position of each token in its segment.
+        rows, cols (torch.Tensor): row and column of every special token.
+        is_edge (torch.Tensor): whether each special token is in the first or last column.
     """
-    input_ids = tokenized["input_ids"]
     bs, num_token = input_ids.shape
+    device = input_ids.device
     # special_tokens_mask: bs, num_token. 1 for special tokens. 0 for normal tokens
-    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
+    special_tokens_mask = torch.zeros((bs, num_token), device=device).bool()
     for special_token in special_tokens_list:
         special_tokens_mask |= input_ids == special_token
 
-    # idxs: each row is a list of indices of special tokens
-    idxs = torch.nonzero(special_tokens_mask)
-
-    # generate attention mask and positional ids
-    attention_mask = (
-        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+    rows, cols = torch.nonzero(special_tokens_mask, as_tuple=True)
+    previous_cols = torch.cat([cols.new_zeros(1), cols[:-1]])
+    is_edge = (cols == 0) | (cols == num_token - 1)
+
+    # index of the special token closing each token: specials before it in its row + specials in earlier rows
+    counts = special_tokens_mask.sum(dim=1)
+    row_offsets = torch.cumsum(counts, dim=0) - counts
+    cum_special = torch.cumsum(special_tokens_mask.long(), dim=1)
+    closing = row_offsets[:, None] + cum_special - special_tokens_mask.long()
+    has_closing = closing < (row_offsets + counts)[:, None]
+    # sentinel entry for tokens after the last special token of their row
+    num_special = cols.shape[0]
+    closing = torch.where(has_closing, closing, torch.full_like(closing, num_special))
+    closing_edge = torch.cat([is_edge, is_edge.new_ones(1)])[closing]
+    closing_previous = torch.cat([previous_cols, previous_cols.new_zeros(1)])[closing]
+
+    token_cols = torch.arange(num_token, device=device)[None, :]
+    in_segment = has_closing & ~closing_edge & (closing_previous < token_cols)
+    segment_ids = torch.where(in_segment, closing, torch.full_like(closing, -1))
+    position_ids = torch.where(
+        in_segment, token_cols - closing_previous - 1, torch.zeros_like(closing)
     )
-    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
-    previous_col = 0
-    for i in range(idxs.shape[0]):
-        row, col = idxs[i]
-        if (col == 0) or (col == num_token - 1):
-            attention_mask[row, col, col] = True
-            position_ids[row, col] = 0
-        else:
-            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
-            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
-                0, col - previous_col, device=input_ids.device
-            )
+    return segment_ids, position_ids, rows, cols, is_edge
+
+
+def _segment_attention_mask(segment_ids):
+    """Tokens attend to themselves and to the other tokens of their segment."""
+    num_token = segment_ids.shape[1]
+    same_segment = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids >= 0)[:, :, None]
+    return same_segment | torch.eye(num_token, device=segment_ids.device).bool().unsqueeze(0)
 
-        previous_col = col
+
+def generate_masks_with_special_tokens(tokenized, special_tokens_list, tokenizer):
+    """Generate attention mask between each pair of special tokens
+    Args:
+        input_ids (torch.Tensor): input ids. Shape: [bs, num_token]
+        special_tokens_mask (list): special tokens mask.
+    Returns:
+        torch.Tensor: attention mask between each special tokens.
+    """
+    input_ids = tokenized["input_ids"]
+    segment_ids, position_ids, _, _, _ = _special_token_segments(input_ids, special_tokens_list)
+    attention_mask = _segment_attention_mask(segment_ids)
 
     # # padding mask
     # padding_mask = tokenized['attention_mask']
@@ -231,40 +261,19 @@ def generate_masks_with_special_tokens_and_transfer_map(tokenized, special_token
     """
     input_ids = tokenized["input_ids"]
     bs, num_token = input_ids.shape
-    # special_tokens_mask: bs, num_token. 1 for special tokens. 0 for normal tokens
-    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
-    for special_token in special_tokens_list:
-        special_tokens_mask |= input_ids == special_token
-
-    # idxs: each row is a list of indices of special tokens
-    idxs = torch.nonzero(special_tokens_mask)
+    segment_ids, position_ids, rows, cols, is_edge = _special_token_segments(
+        input_ids, special_tokens_list
+    )
+    attention_mask = _segment_attention_mask(segment_ids)
 
-    # generate attention mask and positional ids
-    attention_mask = (
-        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+    # one category per non-edge special token: the tokens of its segment, without the special token
+    categories = torch.nonzero(~is_edge, as_tuple=True)[0]
+    token_cols = torch.arange(num_token, device=input_ids.device)[None, :]
+    cate_to_token_mask = (segment_ids[rows[categories]] == categories[:, None]) & (
+        token_cols != cols[categories][:, None]
     )
-    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
-    cate_to_token_mask_list = [[] for _ in range(bs)]
-    previous_col = 0
-    for i in range(idxs.shape[0]):
-        row, col = idxs[i]
-        if (col == 0) or (col == num_token - 1):
-            attention_mask[row, col, col] = True
-            position_ids[row, col] = 0
-        else:
-            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
-            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
-                0, col - previous_col, device=input_ids.device
-            )
-            c2t_maski = torch.zeros((num_token), device=input_ids.device).bool()
-            c2t_maski[previous_col + 1 : col] = True
-            cate_to_token_mask_list[row].append(c2t_maski)
-        previous_col = col
-
-    cate_to_token_mask_list = [
-        torch.stack(cate_to_token_mask_listi, dim=0)
-        for cate_to_token_mask_listi in cate_to_token_mask_list
-    ]
+    categories_per_row = torch.bincount(rows[categories], minlength=bs).tolist()
+    cate_to_token_mask_list = list(torch.split(cate_to_token_mask, categories_per_row, dim=0))
 
     # # padding mask
     # padding_mask = tokenized['attention_mask']
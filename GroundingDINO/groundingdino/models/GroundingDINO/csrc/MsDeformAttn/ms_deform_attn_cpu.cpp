@@ -8,13 +8,87 @@
 **************************************************************************************************
 */
 
+#include <cmath>
 #include <vector>
 
 #include <ATen/ATen.h>
-#include <ATen/cuda/CUDAContext.h>
+#include <ATen/Parallel.h>
 
 namespace groundingdino {
 
+template <typename scalar_t>
+void ms_deform_attn_cpu_forward_kernel(
+    const scalar_t *data_value,
+    const int64_t *data_spatial_shapes,
+    const int64_t *data_level_start_index,
+    const scalar_t *data_sampling_loc,
+    const scalar_t *data_attn_weight,
+    const int64_t batch_size,
+    const int64_t spatial_size,
+    const int64_t num_heads,
+    const int64_t channels,
+    const int64_t num_levels,
+    const int64_t num_query,
+    const int64_t num_point,
+    scalar_t *data_output)
+{
+  const int64_t w_stride = num_heads * channels;
+  // one task per (batch, query, head); the channels of a head are contiguous in value and output
+  at::parallel_for(0, batch_size * num_query * num_heads, 16, [&](int64_t begin, int64_t end) {
+    for (int64_t index = begin; index < end; ++index)
+    {
+      const int64_t m_col = index % num_heads;
+      const int64_t b_col = index / (num_query * num_heads);
+      scalar_t *data_col_ptr = data_output + index * channels;
+      const scalar_t *data_loc_w_ptr = data_sampling_loc + index * num_levels * num_point * 2;
+      const scalar_t *data_weight_ptr = data_attn_weight + index * num_levels * num_point;
+
+      for (int64_t l_col = 0; l_col < num_levels; ++l_col)
+      {
+        const int64_t spatial_h = data_spatial_shapes[l_col * 2];
+        const int64_t spatial_w = data_spatial_shapes[l_col * 2 + 1];
+        const int64_t h_stride = spatial_w * w_stride;
+        const scalar_t *data_value_ptr = data_value
+            + ((b_col * spatial_size + data_level_start_index[l_col]) * num_heads + m_col) * channels;
+
+        for (int64_t p_col = 0; p_col < num_point; ++p_col, data_loc_w_ptr += 2, ++data_weight_ptr)
+        {
+          // same sampling as ms_deform_attn_im2col_bilinear (grid_sample, align_corners=False)
+          const scalar_t h_im = data_loc_w_ptr[1] * spatial_h - 0.5;
+          const scalar_t w_im = data_loc_w_ptr[0] * spatial_w - 0.5;
+          if (!(h_im > -1 && w_im > -1 && h_im < spatial_h && w_im < spatial_w))
+          {
+            continue;
+          }
+          const int64_t h_low = std::floor(h_im);
+          const int64_t w_low = std::floor(w_im);
+          const scalar_t lh = h_im - h_low;
+          const scalar_t lw = w_im - w_low;
+          const scalar_t hh = 1 - lh, hw = 1 - lw;
+          const scalar_t weight = *data_weight_ptr;
+
+          auto add_corner = [&](const int64_t h, const int64_t w, const scalar_t corner_weight) {
+            if (h < 0 || w < 0 || h > spatial_h - 1 || w > spatial_w - 1)
+            {
+              return;
+            }
+            const scalar_t *corner_ptr = data_value_ptr + h * h_stride + w * w_stride;
+            const scalar_t scale = corner_weight * weight;
+            for (int64_t c_col = 0; c_col < channels; ++c_col)
+            {
+              data_col_ptr[c_col] += scale * corner_ptr[c_col];
+            }
+          };
+          add_corner(h_low, w_low, hh * hw);
+          add_corner(h_low, w_low + 1, hh * lw);
+          add_corner(h_low + 1, w_low, lh * hw);
+          add_corner(h_low + 1, w_low + 1, lh * lw);
+        }
+      }
+    }
+  });
+}
+
 at::Tensor
 ms_deform_attn_cpu_forward(
     const at::Tensor &value, 
@@ -24,7 +98,40 @@ ms_deform_attn_cpu_forward(
     const at::Tensor &attn_weight,
     const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
+    AT_ASSERTM(!value.is_cuda(), "value must be a CPU tensor");
+    AT_ASSERTM(value.scalar_type() == sampling_loc.scalar_type(), "value and sampling_loc must have the same dtype");
+    AT_ASSERTM(value.scalar_type() == attn_weight.scalar_type(), "value and attn_weight must have the same dtype");
+
+    // im2col_step only batches the CUDA kernel, every (batch, query, head) is a task here
+    const auto value_ = value.contiguous();
+    const auto spatial_shapes_ = spatial_shapes.contiguous().to(at::kLong);
+    const auto level_start_index_ = level_start_index.contiguous().to(at::kLong);
+    const auto sampling_loc_ = sampling_loc.contiguous();
+    const auto attn_weight_ = attn_weight.contiguous();
+
+    const int64_t batch = value_.size(0);
+    const int64_t spatial_size = value_.size(1);
+    const int64_t num_heads = value_.size(2);
+    const int64_t channels = value_.size(3);
+
+    const int64_t num_levels = spatial_shapes_.size(0);
+
+    const int64_t num_query = sampling_loc_.size(1);
+    const int64_t num_point = sampling_loc_.size(4);
+
+    auto output = at::zeros({batch, num_query, num_heads * channels}, value_.options());
+
+    AT_DISPATCH_FLOATING_TYPES(value_.scalar_type(), "ms_deform_attn_cpu_forward", ([&] {
+        ms_deform_attn_cpu_forward_kernel<scalar_t>(
+            value_.data_ptr<scalar_t>(),
+            spatial_shapes_.data_ptr<int64_t>(),
+            level_start_index_.data_ptr<int64_t>(),
+            sampling_loc_.data_ptr<scalar_t>(),
+            attn_weight_.data_ptr<scalar_t>(),
+            batch, spatial_size, num_heads, channels, num_levels, num_query, num_point,
+            output.data_ptr<scalar_t>());
+    }));
+    return output;
 }
 
 std::vector<at::Tensor>
@@ -53,6 +53,7 @@ std::string get_compiler_version() {
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("ms_deform_attn_forward", &ms_deform_attn_forward, "ms_deform_attn_forward");
   m.def("ms_deform_attn_backward", &ms_deform_attn_backward, "ms_deform_attn_backward");
+  m.def("ms_deform_attn_cpu_forward", &ms_deform_attn_cpu_forward, "ms_deform_attn_cpu_forward");
 }
 
 } // namespace groundingdino
\ No newline at end of file
@@ -171,7 +171,9 @@ class BiMultiHeadAttention(nn.Module):
         value_l_states = value_l_states.view(*proj_shape)
 
         src_len = key_states.size(1)
-        attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))  # bs*nhead, nimg, ntxt
+        # attention logits in fp32 under autocast; the clamps and softmaxes below then run in fp32 too
+        with torch.autocast(device_type=v.device.type, enabled=False):
+            attn_weights = torch.bmm(query_states.float(), key_states.float().transpose(1, 2))  # bs*nhead, nimg, ntxt
 
         if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
             raise ValueError(
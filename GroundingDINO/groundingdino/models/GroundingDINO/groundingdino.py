@@ -19,12 +19,14 @@ from typing import List
 
 import torch
 import torch.nn.functional as F
+from timm.models.layers import DropPath
 from torch import nn
 from torchvision.ops.boxes import nms
 from transformers import AutoTokenizer, BertModel, BertTokenizer, RobertaModel, RobertaTokenizerFast
 
 from groundingdino.util import box_ops, get_tokenlizer
 from groundingdino.util.misc import (
+    LRUCache,
     NestedTensor,
     accuracy,
     get_world_size,
@@ -74,6 +76,7 @@ class GroundingDINO(nn.Module):
         text_encoder_type="bert-base-uncased",
         sub_sentence_present=True,
         max_text_len=256,
+        text_cache_size=16,
     ):
         """Initializes the model.
         Parameters:
@@ -82,6 +85,7 @@ class GroundingDINO(nn.Module):
             num_queries: number of object queries, ie detection slot. This is the maximal number of objects
                          Conditional DETR can detect in a single image. For COCO, we recommend 100 queries.
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
+            text_cache_size: maximal number of encoded captions kept for inference. 0 disables the cache.
         """
         super().__init__()
         self.num_queries = num_queries
@@ -118,6 +122,10 @@ class GroundingDINO(nn.Module):
         # special tokens
         self.specical_tokens = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]", ".", "?"])
 
+        # LRU cache of encoded captions, only used at inference
+        self.text_cache_size = text_cache_size
+        self._text_cache = LRUCache(text_cache_size)
+
         # prepare input projection layers
         if num_feature_levels > 1:
             num_backbone_outs = len(backbone.num_channels)
@@ -224,29 +232,39 @@ class GroundingDINO(nn.Module):
     def init_ref_points(self, use_num_queries):
         self.refpoint_embed = nn.Embedding(use_num_queries, self.query_dim)
 
-    def forward(self, samples: NestedTensor, targets: List = None, **kw):
-        """The forward expects a NestedTensor, which consists of:
-           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
-           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+    def encode_text(self, captions: List[str], device):
+        """Encode captions into the text_dict consumed by the transformer.
 
-        It returns a dict with the following elements:
-           - "pred_logits": the classification logits (including no-object) for all queries.
-                            Shape= [batch_size x num_queries x num_classes]
-           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
-                           (center_x, center_y, width, height). These values are normalized in [0, 1],
-                           relative to the size of each individual image (disregarding possible padding).
-                           See PostProcess for information on how to retrieve the unnormalized bounding box.
-           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
-                            dictionnaries containing the two above keys for each decoder layer.
+        At inference the result is memoized per (distinct captions, device), as the BERT
+        pass is independent of the image: only the distinct captions are encoded and
+        cached, and their rows are expanded to the batch, so the same caption repeated for
+        any number of images shares one entry. Captions are padded to the longest one
+        either way, so the result is the same as encoding the full list. A new dict is
+        returned since the transformer replaces "encoded_text" in place.
         """
-        if targets is None:
-            captions = kw["captions"]
-        else:
-            captions = [t["caption"] for t in targets]
-
-        # encoder texts
+        use_cache = self.text_cache_size > 0 and not self.training and not torch.is_grad_enabled()
+        if not use_cache:
+            return self._encode_text(captions, device)
+
+        unique_captions = list(dict.fromkeys(captions))
+        # features encoded under autocast differ in dtype and precision from fp32 ones
+        key = (tuple(unique_captions), str(device), _autocast_state(device))
+        text_dict = self._text_cache.get(key)
+        if text_dict is None:
+            text_dict = self._text_cache.put(key, self._encode_text(unique_captions, device))
+        if len(unique_captions) == 1:
+            # views, no copy
+            return {k: v.expand(len(captions), *v.shape[1:]) for k, v in text_dict.items()}
+        row = {caption: i for i, caption in enumerate(unique_captions)}
+        index = torch.as_tensor([row[caption] for caption in captions], device=device)
+        return {k: v.index_select(0, index) for k, v in text_dict.items()}
+
+    def clear_text_cache(self):
+        self._text_cache.clear()
+
+    def _encode_text(self, captions: List[str], device):
         tokenized = self.tokenizer(captions, padding="longest", return_tensors="pt").to(
-            samples.device
+            device
         )
         (
             text_self_attention_masks,
@@ -295,12 +313,37 @@ class GroundingDINO(nn.Module):
             "position_ids": position_ids,  # bs, 195
             "text_self_attention_masks": text_self_attention_masks,  # bs, 195,195
         }
+        return text_dict
+
+    def forward(self, samples: NestedTensor, targets: List = None, **kw):
+        """The forward expects a NestedTensor, which consists of:
+           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
+           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+
+        It returns a dict with the following elements:
+           - "pred_logits": the classification logits (including no-object) for all queries.
+                            Shape= [batch_size x num_queries x num_classes]
+           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
+                           (center_x, center_y, width, height). These values are normalized in [0, 1],
+                           relative to the size of each individual image (disregarding possible padding).
+                           See PostProcess for information on how to retrieve the unnormalized bounding box.
+           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
+                            dictionnaries containing the two above keys for each decoder layer.
+        """
+        if targets is None:
+            captions = kw["captions"]
+        else:
+            captions = [t["caption"] for t in targets]
+
+        text_dict = self.encode_text(captions, samples.device)
 
         # import ipdb; ipdb.set_trace()
         if isinstance(samples, (list, torch.Tensor)):
             samples = nested_tensor_from_tensor_list(samples)
         if not hasattr(self, 'features') or not hasattr(self, 'poss'):
             self.set_image_tensor(samples)
+        # copy, so the extra levels appended below do not leak into features kept via unset_image_tensor=False
+        poss = list(self.poss)
 
         srcs = []
         masks = []
@@ -318,23 +361,32 @@ class GroundingDINO(nn.Module):
                     src = self.input_proj[l](srcs[-1])
                 m = samples.mask
                 mask = F.interpolate(m[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
-                pos_l = self.backbone[1](NestedTensor(src, mask)).to(src.dtype)
+                pos_l = self.backbone[1](NestedTensor(src, mask, samples.unpadded)).to(src.dtype)
                 srcs.append(src)
                 masks.append(mask)
-                self.poss.append(pos_l)
+                poss.append(pos_l)
 
         input_query_bbox = input_query_label = attn_mask = dn_meta = None
+        # taken from the features, which may come from an earlier set_image_tensor
+        unpadded = all(feat.unpadded for feat in self.features)
         hs, reference, hs_enc, ref_enc, init_box_proposal = self.transformer(
-            srcs, masks, input_query_bbox, self.poss, input_query_label, attn_mask, text_dict
+            srcs, masks, input_query_bbox, poss, input_query_label, attn_mask, text_dict, unpadded=unpadded
         )
 
+        if not (self.aux_loss or self.training):
+            # only the last decoder layer is returned, skip the heads of the others
+            reference, hs = reference[-2:], hs[-1:]
+            bbox_embed, class_embed = self.bbox_embed[-1:], self.class_embed[-1:]
+        else:
+            bbox_embed, class_embed = self.bbox_embed, self.class_embed
+
         # deformable-detr-like anchor update
         outputs_coord_list = []
         for dec_lid, (layer_ref_sig, layer_bbox_embed, layer_hs) in enumerate(
-            zip(reference[:-1], self.bbox_embed, hs)
+            zip(reference[:-1], bbox_embed, hs)
         ):
             layer_delta_unsig = layer_bbox_embed(layer_hs)
-            layer_outputs_unsig = layer_delta_unsig + inverse_sigmoid(layer_ref_sig)
+            layer_outputs_unsig = layer_delta_unsig.float() + inverse_sigmoid(layer_ref_sig.float())
             layer_outputs_unsig = layer_outputs_unsig.sigmoid()
             outputs_coord_list.append(layer_outputs_unsig)
         outputs_coord_list = torch.stack(outputs_coord_list)
@@ -343,7 +395,7 @@ class GroundingDINO(nn.Module):
         outputs_class = torch.stack(
             [
                 layer_cls_embed(layer_hs, text_dict)
-                for layer_cls_embed, layer_hs in zip(self.class_embed, hs)
+                for layer_cls_embed, layer_hs in zip(class_embed, hs)
             ]
         )
         out = {"pred_logits": outputs_class[-1], "pred_boxes": outputs_coord_list[-1]}
@@ -375,8 +427,31 @@ class GroundingDINO(nn.Module):
         ]
 
 
+def _autocast_state(device):
+    """The autocast dtype in effect for device, or None outside of autocast."""
+    if torch.device(device).type == "cuda":
+        return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
+    return torch.get_autocast_cpu_dtype() if torch.is_autocast_cpu_enabled() else None
+
+
+def strip_dropout(module: nn.Module) -> nn.Module:
+    """Replaces every Dropout / DropPath in module (in place) with nn.Identity, for inference only."""
+    for name, child in module.named_children():
+        if isinstance(child, (nn.Dropout, DropPath)):
+            setattr(module, name, nn.Identity())
+        else:
+            strip_dropout(child)
+    return module
+
+
 @MODULE_BUILD_FUNCS.registe_with_name(module_name="groundingdino")
 def build_groundingdino(args):
+    # inference: no activation checkpointing (pure overhead without autograd), no dropout,
+    # and no heads for the intermediate decoder layers
+    inference = getattr(args, "inference", False)
+    if inference:
+        args.use_checkpoint = False
+        args.use_transformer_ckpt = False
 
     backbone = build_backbone(args)
     transformer = build_transformer(args)
@@ -389,7 +464,7 @@ def build_groundingdino(args):
         backbone,
         transformer,
         num_queries=args.num_queries,
-        aux_loss=True,
+        aux_loss=not inference,
         iter_update=True,
         query_dim=4,
         num_feature_levels=args.num_feature_levels,
@@ -406,7 +481,10 @@ def build_groundingdino(args):
         text_encoder_type=args.text_encoder_type,
         sub_sentence_present=sub_sentence_present,
         max_text_len=args.max_text_len,
+        text_cache_size=getattr(args, "text_cache_size", 16),
     )
+    if inference:
+        strip_dropout(model)
 
     return model
 
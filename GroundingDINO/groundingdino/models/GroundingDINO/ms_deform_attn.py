@@ -28,8 +28,12 @@ from torch.nn.init import constant_, xavier_uniform_
 try:
     from groundingdino import _C
 except:
+    _C = None
     warnings.warn("Failed to load custom C++ ops. Running on CPU mode Only!")
 
+# forward-only CPU kernel, missing from extensions built before it was added
+_HAS_CPU_KERNEL = hasattr(_C, "ms_deform_attn_cpu_forward")
+
 
 # helpers
 def _is_power_of_2(n):
@@ -133,6 +137,67 @@ def multi_scale_deformable_attn_pytorch(
     return output.transpose(1, 2).contiguous()
 
 
+def multi_scale_deformable_attn_gather(
+    value: torch.Tensor,
+    value_spatial_shapes: torch.Tensor,
+    value_level_start_index: torch.Tensor,
+    sampling_locations: torch.Tensor,
+    attention_weights: torch.Tensor,
+) -> torch.Tensor:
+    """Same result as multi_scale_deformable_attn_pytorch, computed for all levels at once.
+
+    The bilinear corners of every sampling point are turned into row indices of the
+    flattened value tensor, and F.embedding_bag sums the rows weighted by bilinear weight
+    times attention weight. Nothing of size (queries x levels x points x channels) is
+    materialized, which makes it the faster path on CPU.
+    """
+    bs, num_value, num_heads, embed_dims = value.shape
+    _, num_queries, _, num_levels, num_points, _ = sampling_locations.shape
+    # bs, num_heads, num_queries, num_levels, num_points
+    sampling_locations = sampling_locations.transpose(1, 2)
+    attention_weights = attention_weights.transpose(1, 2)
+    level_h = value_spatial_shapes[:, 0].view(1, 1, 1, num_levels, 1)
+    level_w = value_spatial_shapes[:, 1].view(1, 1, 1, num_levels, 1)
+    # first row of every (batch, head, level) in the flattened value tensor
+    level_start = (
+        torch.arange(bs * num_heads, device=value.device).view(bs, num_heads, 1, 1, 1) * num_value
+        + value_level_start_index.view(1, 1, 1, num_levels, 1)
+    )
+
+    # pixel coordinates as in F.grid_sample(align_corners=False)
+    x = sampling_locations[..., 0] * level_w - 0.5
+    y = sampling_locations[..., 1] * level_h - 0.5
+    x0 = x.floor()
+    y0 = y.floor()
+    fx = x - x0
+    fy = y - y0
+    x0 = x0.long()
+    y0 = y0.long()
+
+    indices = []
+    weights = []
+    for dy, weight_y in ((0, 1 - fy), (1, fy)):
+        for dx, weight_x in ((0, 1 - fx), (1, fx)):
+            xi = x0 + dx
+            yi = y0 + dy
+            # corners outside the level contribute zeros (padding_mode="zeros")
+            valid = (xi >= 0) & (xi < level_w) & (yi >= 0) & (yi < level_h)
+            indices.append(torch.where(valid, level_start + yi * level_w + xi, torch.zeros_like(xi)))
+            weights.append(weight_x * weight_y * attention_weights * valid)
+
+    samples_per_query = num_levels * num_points * 4
+    indices = torch.stack(indices, -1).view(-1, samples_per_query)
+    weights = torch.stack(weights, -1).view(-1, samples_per_query).to(value.dtype)
+    value = value.transpose(1, 2).reshape(bs * num_heads * num_value, embed_dims)
+    output = F.embedding_bag(indices, value, per_sample_weights=weights, mode="sum")
+    # bs*num_heads*num_queries, embed_dims -> bs, num_queries, num_heads*embed_dims
+    return (
+        output.view(bs, num_heads, num_queries, embed_dims)
+        .transpose(1, 2)
+        .reshape(bs, num_queries, num_heads * embed_dims)
+    )
+
+
 class MultiScaleDeformableAttention(nn.Module):
     """Multi-Scale Deformable Attention Module used in Deformable-DETR
 
@@ -327,14 +392,14 @@ class MultiScaleDeformableAttention(nn.Module):
                 )
             )
     
-        if torch.cuda.is_available() and value.is_cuda:
-            halffloat = False
-            if value.dtype == torch.float16:
-                halffloat = True
-                value = value.float()
-                sampling_locations = sampling_locations.float()
-                attention_weights = attention_weights.float()
+        # the CUDA op and grid_sample both sample in fp32 (and need matching dtypes)
+        input_dtype = value.dtype
+        if input_dtype in (torch.float16, torch.bfloat16):
+            value = value.float()
+            sampling_locations = sampling_locations.float()
+            attention_weights = attention_weights.float()
 
+        if torch.cuda.is_available() and value.is_cuda:
             output = MultiScaleDeformableAttnFunction.apply(
                 value,
                 spatial_shapes,
@@ -343,13 +408,22 @@ class MultiScaleDeformableAttention(nn.Module):
                 attention_weights,
                 self.im2col_step,
             )
-
-            if halffloat:
-                output = output.half()
+        elif _HAS_CPU_KERNEL and not (
+            value.requires_grad or sampling_locations.requires_grad or attention_weights.requires_grad
+        ):
+            output = _C.ms_deform_attn_cpu_forward(
+                value,
+                spatial_shapes,
+                level_start_index,
+                sampling_locations,
+                attention_weights,
+                self.im2col_step,
+            )
         else:
-            output = multi_scale_deformable_attn_pytorch(
-                value, spatial_shapes, sampling_locations, attention_weights
+            output = multi_scale_deformable_attn_gather(
+                value, spatial_shapes, level_start_index, sampling_locations, attention_weights
             )
+        output = output.to(input_dtype)
 
         output = self.output_proj(output)
 
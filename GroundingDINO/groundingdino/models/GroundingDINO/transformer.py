@@ -22,7 +22,7 @@ import torch
 import torch.utils.checkpoint as checkpoint
 from torch import Tensor, nn
 
-from groundingdino.util.misc import inverse_sigmoid
+from groundingdino.util.misc import LRUCache, inverse_sigmoid
 
 from .fuse_modules import BiAttentionBlock
 from .ms_deform_attn import MultiScaleDeformableAttention as MSDeformAttn
@@ -36,6 +36,13 @@ from .utils import (
     get_sine_pos_embed,
 )
 
+# number of input resolutions whose level metadata / encoder reference grids are kept
+LEVEL_METADATA_CACHE_SIZE = 32
+REFERENCE_GRID_CACHE_SIZE = 32
+# number of (resolution, batch size) pairs whose unpadded reference points are kept (~0.7 MB
+# per 800 x 1333 image)
+UNPADDED_REFERENCE_POINTS_CACHE_SIZE = 16
+
 
 class Transformer(nn.Module):
     def __init__(
@@ -71,6 +78,7 @@ class Transformer(nn.Module):
         text_dropout=0.1,
         fusion_dropout=0.1,
         fusion_droppath=0.0,
+        check_numerics=False,
     ):
         super().__init__()
         self.num_feature_levels = num_feature_levels
@@ -141,6 +149,7 @@ class Transformer(nn.Module):
             d_model=d_model,
             query_dim=query_dim,
             num_feature_levels=num_feature_levels,
+            check_numerics=check_numerics,
         )
 
         self.d_model = d_model
@@ -184,6 +193,9 @@ class Transformer(nn.Module):
         self.enc_out_class_embed = None
         self.enc_out_bbox_embed = None
 
+        # (spatial shapes, device) -> (spatial_shapes, level_start_index), see get_level_metadata
+        self._level_metadata = LRUCache(LEVEL_METADATA_CACHE_SIZE)
+
         self._reset_parameters()
 
     def _reset_parameters(self):
@@ -205,10 +217,25 @@ class Transformer(nn.Module):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
+    def get_level_metadata(self, spatial_shapes, device):
+        """spatial_shapes [num_levels, 2] and level_start_index [num_levels] tensors for the
+        given tuple of per-level (h, w), built once per resolution and device."""
+        key = (spatial_shapes, device)
+        metadata = self._level_metadata.get(key)
+        if metadata is None:
+            spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=device)
+            level_start_index = torch.cat(
+                (spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1])
+            )
+            metadata = self._level_metadata.put(key, (spatial_shapes, level_start_index))
+        return metadata
+
     def init_ref_points(self, use_num_queries):
         self.refpoint_embed = nn.Embedding(use_num_queries, 4)
 
-    def forward(self, srcs, masks, refpoint_embed, pos_embeds, tgt, attn_mask=None, text_dict=None):
+    def forward(
+        self, srcs, masks, refpoint_embed, pos_embeds, tgt, attn_mask=None, text_dict=None, unpadded=False
+    ):
         """
         Input:
             - srcs: List of multi features [bs, ci, hi, wi]
@@ -216,6 +243,8 @@ class Transformer(nn.Module):
             - refpoint_embed: [bs, num_dn, 4]. None in infer
             - pos_embeds: List of multi pos embeds [bs, ci, hi, wi]
             - tgt: [bs, num_dn, d_model]. None in infer
+            - unpadded: True if all masks are known to be all False (see NestedTensor.unpadded),
+              the valid ratios and encoder reference points are then taken from a cache
 
         """
         # prepare input for encoder
@@ -241,13 +270,19 @@ class Transformer(nn.Module):
         src_flatten = torch.cat(src_flatten, 1)  # bs, \sum{hxw}, c
         mask_flatten = torch.cat(mask_flatten, 1)  # bs, \sum{hxw}
         lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1)  # bs, \sum{hxw}, c
-        spatial_shapes = torch.as_tensor(
-            spatial_shapes, dtype=torch.long, device=src_flatten.device
-        )
-        level_start_index = torch.cat(
-            (spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1])
-        )
-        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        level_shapes = tuple(spatial_shapes)
+        spatial_shapes, level_start_index = self.get_level_metadata(level_shapes, src_flatten.device)
+        if unpadded:
+            valid_ratios, encoder_reference_points = self.encoder.get_unpadded_reference_points(
+                level_shapes, bs, src_flatten.device
+            )
+        else:
+            valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+            encoder_reference_points = (
+                self.encoder.get_cached_reference_points(level_shapes, valid_ratios, src_flatten.device)
+                if self.num_encoder_layers > 0
+                else None
+            )
 
         # two stage
         enc_topk_proposals = enc_refpoint_embed = None
@@ -267,6 +302,7 @@ class Transformer(nn.Module):
             # we ~ the mask . False means use the token; True means pad the token
             position_ids=text_dict["position_ids"],
             text_self_attention_masks=text_dict["text_self_attention_masks"],
+            reference_points=encoder_reference_points,
         )
         #########################################################
         # End Encoder
@@ -294,7 +330,7 @@ class Transformer(nn.Module):
 
             topk_logits = enc_outputs_class_unselected.max(-1)[0]
             enc_outputs_coord_unselected = (
-                self.enc_out_bbox_embed(output_memory) + output_proposals
+                self.enc_out_bbox_embed(output_memory).float() + output_proposals.float()
             )  # (bs, \sum{hw}, 4) unsigmoid
             topk = self.num_queries
 
@@ -462,6 +498,61 @@ class TransformerEncoder(nn.Module):
         self.use_checkpoint = use_checkpoint
         self.use_transformer_ckpt = use_transformer_ckpt
 
+        # (spatial shapes, device) -> per-level grids, see get_reference_grid
+        self._reference_grids = LRUCache(REFERENCE_GRID_CACHE_SIZE)
+        # (spatial shapes, batch size, device) -> (valid_ratios, reference_points), see get_unpadded_reference_points
+        self._unpadded_reference_points = LRUCache(UNPADDED_REFERENCE_POINTS_CACHE_SIZE)
+
+    def get_reference_grid(self, spatial_shapes, device):
+        """Shape-only part of get_reference_points, built once per resolution and device.
+        Args:
+            spatial_shapes: tuple of (h, w) per level
+        Returns:
+            centers: [sum(hi*wi), 2] (x, y) cell centers in pixels of their level
+            sizes: [sum(hi*wi), 2] (w, h) of the level of each cell
+            levels: [sum(hi*wi)] level of each cell
+        """
+        key = (spatial_shapes, device)
+        grid = self._reference_grids.get(key)
+        if grid is not None:
+            return grid
+
+        centers, sizes, levels = [], [], []
+        for lvl, (H_, W_) in enumerate(spatial_shapes):
+            ref_y, ref_x = torch.meshgrid(
+                torch.linspace(0.5, H_ - 0.5, H_, dtype=torch.float32, device=device),
+                torch.linspace(0.5, W_ - 0.5, W_, dtype=torch.float32, device=device),
+            )
+            centers.append(torch.stack((ref_x.reshape(-1), ref_y.reshape(-1)), -1))
+            sizes.append(
+                torch.tensor([W_, H_], dtype=torch.float32, device=device).expand(H_ * W_, 2)
+            )
+            levels.append(torch.full((H_ * W_,), lvl, dtype=torch.long, device=device))
+        return self._reference_grids.put(
+            key, (torch.cat(centers, 0), torch.cat(sizes, 0), torch.cat(levels, 0))
+        )
+
+    def get_cached_reference_points(self, spatial_shapes, valid_ratios, device):
+        """Same result as get_reference_points, without rebuilding the grids (nor reading
+        spatial_shapes back from the device) for a resolution that was seen before."""
+        centers, sizes, levels = self.get_reference_grid(spatial_shapes, device)
+        reference_points = centers[None] / (valid_ratios[:, levels] * sizes[None])
+        reference_points = reference_points[:, :, None] * valid_ratios[:, None]
+        return reference_points
+
+    def get_unpadded_reference_points(self, spatial_shapes, bs, device):
+        """valid_ratios [bs, num_level, 2] (all 1) and the get_reference_points output for a
+        batch of bs inputs without padding, built once per resolution, batch size and device.
+        The returned tensors are shared between calls and must not be modified in place."""
+        key = (spatial_shapes, bs, device)
+        cached = self._unpadded_reference_points.get(key)
+        if cached is None:
+            valid_ratios = torch.ones(bs, len(spatial_shapes), 2, dtype=torch.float32, device=device)
+            cached = self._unpadded_reference_points.put(
+                key, (valid_ratios, self.get_cached_reference_points(spatial_shapes, valid_ratios, device))
+            )
+        return cached
+
     @staticmethod
     def get_reference_points(spatial_shapes, valid_ratios, device):
         reference_points_list = []
@@ -494,6 +585,7 @@ class TransformerEncoder(nn.Module):
         pos_text: Tensor = None,
         text_self_attention_masks: Tensor = None,
         position_ids: Tensor = None,
+        reference_points: Tensor = None,
     ):
         """
         Input:
@@ -510,6 +602,8 @@ class TransformerEncoder(nn.Module):
             - pos_text: bs, n_text, 256
 
             - position_ids: bs, n_text
+
+            - reference_points: precomputed get_reference_points output, optional
         Intermedia:
             - reference_points: [bs, sum(hi*wi), num_level, 2]
         Outpus:
@@ -519,7 +613,7 @@ class TransformerEncoder(nn.Module):
         output = src
 
         # preparation and reshape
-        if self.num_layers > 0:
+        if self.num_layers > 0 and reference_points is None:
             reference_points = self.get_reference_points(
                 spatial_shapes, valid_ratios, device=src.device
             )
@@ -605,6 +699,7 @@ class TransformerDecoder(nn.Module):
         d_model=256,
         query_dim=4,
         num_feature_levels=1,
+        check_numerics=False,
     ):
         super().__init__()
         if num_layers > 0:
@@ -618,6 +713,8 @@ class TransformerDecoder(nn.Module):
         self.query_dim = query_dim
         assert query_dim in [2, 4], "query_dim should be 2/4 but {}".format(query_dim)
         self.num_feature_levels = num_feature_levels
+        # count nan/inf in every layer output, reported once after the forward (one device sync)
+        self.check_numerics = check_numerics
 
         self.ref_point_head = MLP(query_dim // 2 * d_model, d_model, d_model, 2)
         self.query_pos_sine_scale = None
@@ -661,6 +758,7 @@ class TransformerDecoder(nn.Module):
         intermediate = []
         reference_points = refpoints_unsigmoid.sigmoid()
         ref_points = [reference_points]
+        numerics = []
 
         for layer_id, layer in enumerate(self.layers):
 
@@ -701,16 +799,9 @@ class TransformerDecoder(nn.Module):
                 self_attn_mask=tgt_mask,
                 cross_attn_mask=memory_mask,
             )
-            if output.isnan().any() | output.isinf().any():
-                print(f"output layer_id {layer_id} is nan")
-                try:
-                    num_nan = output.isnan().sum().item()
-                    num_inf = output.isinf().sum().item()
-                    print(f"num_nan {num_nan}, num_inf {num_inf}")
-                except Exception as e:
-                    print(e)
-                    # if os.environ.get("SHILONG_AMP_INFNAN_DEBUG") == '1':
-                    #     import ipdb; ipdb.set_trace()
+            if self.check_numerics:
+                # stays on the device, read back after the last layer
+                numerics.append(torch.stack([output.isnan().sum(), output.isinf().sum()]))
 
             # iter update
             if self.bbox_embed is not None:
@@ -718,8 +809,9 @@ class TransformerDecoder(nn.Module):
                 # box_holder[..., :self.query_dim] += inverse_sigmoid(reference_points)
                 # new_reference_points = box_holder[..., :self.query_dim].sigmoid()
 
-                reference_before_sigmoid = inverse_sigmoid(reference_points)
-                delta_unsig = self.bbox_embed[layer_id](output)
+                # refinement in fp32 under autocast, inverse_sigmoid is ill-conditioned near 0 and 1
+                reference_before_sigmoid = inverse_sigmoid(reference_points.float())
+                delta_unsig = self.bbox_embed[layer_id](output).float()
                 outputs_unsig = delta_unsig + reference_before_sigmoid
                 new_reference_points = outputs_unsig.sigmoid()
 
@@ -729,6 +821,12 @@ class TransformerDecoder(nn.Module):
 
             intermediate.append(self.norm(output))
 
+        if numerics:
+            for layer_id, (num_nan, num_inf) in enumerate(torch.stack(numerics).tolist()):
+                if num_nan or num_inf:
+                    print(f"output layer_id {layer_id} is nan")
+                    print(f"num_nan {num_nan}, num_inf {num_inf}")
+
         return [
             [itm_out.transpose(0, 1) for itm_out in intermediate],
             [itm_refpoint.transpose(0, 1) for itm_refpoint in ref_points],
@@ -956,4 +1054,5 @@ def build_transformer(args):
         text_dropout=args.text_dropout,
         fusion_dropout=args.fusion_dropout,
         fusion_droppath=args.fusion_droppath,
+        check_numerics=getattr(args, "check_numerics", False),
     )
@@ -258,7 +258,9 @@ class ContrastiveEmbed(nn.Module):
         y = text_dict["encoded_text"]
         text_token_mask = text_dict["text_token_mask"]
 
-        res = x @ y.transpose(-1, -2)
+        # the logits are thresholded directly, keep them in fp32 under autocast
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            res = x.float() @ y.float().transpose(-1, -2)
         res.masked_fill_(~text_token_mask[:, None, :], float("-inf"))
 
         # padding to max_text_len
@@ -1,4 +1,4 @@
-from typing import Tuple, List
+from typing import Tuple, List, Optional, Union
 
 import cv2
 import numpy as np
@@ -10,10 +10,16 @@ import bisect
 
 import groundingdino.datasets.transforms as T
 from groundingdino.models import build_model
-from groundingdino.util.misc import clean_state_dict
+from groundingdino.util.misc import NestedTensor, clean_state_dict, nested_tensor_from_tensor_list
 from groundingdino.util.slconfig import SLConfig
 from groundingdino.util.utils import get_phrases_from_posmap
 
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+AUTOCAST_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+# static_shapes: inputs are padded up to multiples of this (800 x 800-1333 inputs -> 896 x 896-1408)
+STATIC_SHAPE_DIVISIBILITY = 128
+
 # ----------------------------------------------------------------------------------------------------------------------
 # OLD API
 # ----------------------------------------------------------------------------------------------------------------------
@@ -26,9 +32,14 @@ def preprocess_caption(caption: str) -> str:
     return result + "."
 
 
-def load_model(model_config_path: str, model_checkpoint_path: str, device: str = "cuda"):
+def load_model(model_config_path: str, model_checkpoint_path: str, device: str = "cuda", inference: bool = True):
+    """
+    inference: build the model for inference only (no activation checkpointing, dropout or
+    intermediate decoder heads), regardless of the config. Set to False to fine-tune.
+    """
     args = SLConfig.fromfile(model_config_path)
     args.device = device
+    args.inference = inference
     model = build_model(args)
     checkpoint = torch.load(model_checkpoint_path, map_location="cpu")
     model.load_state_dict(clean_state_dict(checkpoint["model"]), strict=False)
@@ -50,33 +61,121 @@ def load_image(image_path: str) -> Tuple[np.array, torch.Tensor]:
     return image, image_transformed
 
 
+def _place_model(model, device):
+    # Model places its model once at construction; only move models that are elsewhere,
+    # instead of walking every parameter with .to() on each call
+    device = torch.device(device)
+    current = next(model.parameters()).device
+    if current.type != device.type or (device.index is not None and current.index != device.index):
+        model = model.to(device)
+    return model
+
+
 def predict(
         model,
-        image: torch.Tensor,
+        image: Union[torch.Tensor, NestedTensor],
         caption: str,
         box_threshold: float,
         text_threshold: float,
         device: str = "cuda",
-        remove_combined: bool = False
+        remove_combined: bool = False,
+        unset_image_tensor: bool = True,
+        max_detections: Optional[int] = None
 ) -> Tuple[torch.Tensor, torch.Tensor, List[str]]:
+    """
+    image is a single 3 x H x W tensor, or a one-image NestedTensor. If backbone features
+    were stored with model.set_image_tensor, they are used instead of running the backbone,
+    and are kept for further calls when unset_image_tensor is False.
+    max_detections: keep only this many highest scoring boxes above box_threshold.
+    """
+    caption = preprocess_caption(caption=caption)
+
+    model = _place_model(model, device)
+    image = image.to(device, non_blocking=True)
+    samples = image if isinstance(image, NestedTensor) else image[None]
+
+    with torch.no_grad():
+        outputs = model(samples, captions=[caption], unset_image_tensor=unset_image_tensor)
+
+    return _decode_prediction(
+        model=model,
+        pred_logits=outputs["pred_logits"][0],
+        pred_boxes=outputs["pred_boxes"][0],
+        caption=caption,
+        box_threshold=box_threshold,
+        text_threshold=text_threshold,
+        remove_combined=remove_combined,
+        max_detections=max_detections)
+
+
+def predict_batch(
+        model,
+        images: List[torch.Tensor],
+        caption: str,
+        box_threshold: float,
+        text_threshold: float,
+        device: str = "cuda",
+        remove_combined: bool = False,
+        max_detections: Optional[int] = None,
+        size_divisibility: int = 0
+) -> List[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+    """
+    Runs one forward pass over several images of possibly different sizes. The images are
+    zero-padded to a common size (rounded up to size_divisibility, if set) and the padding
+    mask is passed on to the model, so the boxes of every image stay normalized to its own
+    (unpadded) size.
+    """
     caption = preprocess_caption(caption=caption)
 
-    model = model.to(device)
-    image = image.to(device)
+    model = _place_model(model, device)
+    samples = nested_tensor_from_tensor_list(
+        [image.to(device, non_blocking=True) for image in images], size_divisibility=size_divisibility)
 
     with torch.no_grad():
-        outputs = model(image[None], captions=[caption])
+        outputs = model(samples, captions=[caption] * len(images))
 
-    prediction_logits = outputs["pred_logits"].cpu().sigmoid()[0]  # prediction_logits.shape = (nq, 256)
-    prediction_boxes = outputs["pred_boxes"].cpu()[0]  # prediction_boxes.shape = (nq, 4)
+    return [
+        _decode_prediction(
+            model=model,
+            pred_logits=outputs["pred_logits"][i],
+            pred_boxes=outputs["pred_boxes"][i],
+            caption=caption,
+            box_threshold=box_threshold,
+            text_threshold=text_threshold,
+            remove_combined=remove_combined,
+            max_detections=max_detections)
+        for i in range(len(images))
+    ]
 
-    mask = prediction_logits.max(dim=1)[0] > box_threshold
-    logits = prediction_logits[mask]  # logits.shape = (n, 256)
-    boxes = prediction_boxes[mask]  # boxes.shape = (n, 4)
 
+def _decode_prediction(
+        model,
+        pred_logits: torch.Tensor,
+        pred_boxes: torch.Tensor,
+        caption: str,
+        box_threshold: float,
+        text_threshold: float,
+        remove_combined: bool = False,
+        max_detections: Optional[int] = None
+) -> Tuple[torch.Tensor, torch.Tensor, List[str]]:
     tokenizer = model.tokenizer
     tokenized = tokenizer(caption)
-    
+    num_tokens = len(tokenized["input_ids"])
+
+    # threshold on the device and copy back only the surviving queries, and of their token
+    # probabilities only the caption tokens (the rest of the 256 are masked to 0)
+    prediction_logits = pred_logits.sigmoid()  # prediction_logits.shape = (nq, 256)
+    scores = prediction_logits.max(dim=1)[0]
+    keep = torch.nonzero(scores > box_threshold, as_tuple=True)[0]
+    if max_detections is not None and len(keep) > max_detections:
+        keep = keep[scores[keep].topk(max_detections).indices.sort().values]
+    packed = torch.cat(
+        [pred_boxes[keep], scores[keep, None], prediction_logits[keep, :num_tokens]], dim=1
+    ).float().cpu()
+    boxes = packed[:, :4]  # boxes.shape = (n, 4)
+    scores = packed[:, 4]
+    logits = packed[:, 5:]  # logits.shape = (n, num_tokens)
+
     if remove_combined:
         sep_idx = [i for i in range(len(tokenized['input_ids'])) if tokenized['input_ids'][i] in [101, 102, 1012]]
         
@@ -94,7 +193,7 @@ def predict(
             in logits
         ]
 
-    return boxes, logits.max(dim=1)[0], phrases
+    return boxes, scores, phrases
 
 
 def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor, phrases: List[str]) -> np.ndarray:
@@ -140,23 +239,105 @@ class Model:
         self,
         model_config_path: str,
         model_checkpoint_path: str,
-        device: str = "cuda"
+        device: str = "cuda",
+        precision: str = "fp32",
+        static_shapes: bool = False,
+        compile_model: bool = False,
+        static_batch_size: int = 0
     ):
+        """
+        precision: "fp32", or "bf16" / "fp16" to run under torch.autocast. The fusion
+        softmax, the box refinement and the contrastive class logits stay in fp32 either way.
+        static_shapes: pad every input up to a multiple of STATIC_SHAPE_DIVISIBILITY, so the
+        model only ever sees a handful of image shapes. The transformer ignores the padding,
+        but the Swin backbone does not, so boxes near the right and bottom border can differ
+        slightly from those of the unpadded image (as in any padded batch).
+        compile_model: torch.compile the backbone and the transformer encoder and decoder.
+        Each input shape (batch size, image shape and caption length) is compiled once, so use
+        it together with static_shapes, static_batch_size and fixed classes.
+        static_batch_size: with static_shapes, predict_batch_with_classes splits larger batches
+        into chunks of this many images and fills the last one up (copies of its last image,
+        whose outputs are dropped), so that the model sees a single batch size at the cost of
+        running the fillers.
+        """
+        if precision not in AUTOCAST_DTYPES:
+            raise ValueError(f"precision must be one of {sorted(AUTOCAST_DTYPES)}, got {precision!r}")
         self.model = load_model(
             model_config_path=model_config_path,
             model_checkpoint_path=model_checkpoint_path,
             device=device
         ).to(device)
         self.device = device
+        self.precision = precision
+        self.size_divisibility = STATIC_SHAPE_DIVISIBILITY if static_shapes else 0
+        self.static_batch_size = static_batch_size if static_shapes else 0
+        if compile_model:
+            if not static_shapes:
+                print("WARN: compile_model without static_shapes recompiles for almost every image size")
+            self.model.backbone[0] = torch.compile(self.model.backbone[0], dynamic=False)
+            # the encoder and decoder only, Transformer.forward looks up per-shape metadata in
+            # LRUCaches that are kept out of the traced graphs
+            transformer = self.model.transformer
+            transformer.encoder = torch.compile(transformer.encoder, dynamic=False)
+            transformer.decoder = torch.compile(transformer.decoder, dynamic=False)
+        self._image_samples = None
+        self._image_source_size = None
+
+    def set_image(self, image: Union[np.ndarray, torch.Tensor], channel_order: str = "bgr") -> None:
+        """
+        Runs the Swin backbone on image once and keeps its features, so that following
+        predict_with_caption / predict_with_classes calls with image=None (any caption or
+        thresholds) only run the text encoder and transformer. Call unset_image() when done.
+        """
+        processed_image = Model.preprocess_image(image=image, channel_order=channel_order, device=self.device)
+        self.unset_image()
+        samples = nested_tensor_from_tensor_list([processed_image], size_divisibility=self.size_divisibility)
+        with torch.no_grad(), self._autocast():
+            self.model.set_image_tensor(samples)
+        self._image_samples = samples
+        self._image_source_size = tuple(image.shape[:2])
+
+    def unset_image(self) -> None:
+        self.model.unset_image_tensor()
+        self._image_samples = None
+        self._image_source_size = None
+
+    def _autocast(self):
+        dtype = AUTOCAST_DTYPES[self.precision]
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=dtype, enabled=dtype is not None)
+
+    @property
+    def is_image_set(self) -> bool:
+        return self._image_samples is not None
+
+    def _prepare_image(self, image, channel_order: str):
+        # Returns (model input, source (h, w), unset_image_tensor) for image, or for the image given to set_image
+        if image is None:
+            if not self.is_image_set:
+                raise RuntimeError("No image given and no image set, call set_image() first.")
+            return self._image_samples, self._image_source_size, False
+        # the model runs on its stored backbone features whenever there are any, so drop
+        # those of a previous set_image before predicting on another image
+        self.unset_image()
+        processed_image = Model.preprocess_image(image=image, channel_order=channel_order, device=self.device)
+        if self.size_divisibility:
+            processed_image = nested_tensor_from_tensor_list(
+                [processed_image], size_divisibility=self.size_divisibility)
+        return processed_image, image.shape[:2], True
 
     def predict_with_caption(
         self,
         image: np.ndarray,
         caption: str,
         box_threshold: float = 0.35,
-        text_threshold: float = 0.25
+        text_threshold: float = 0.25,
+        channel_order: str = "bgr"
     ) -> Tuple[sv.Detections, List[str]]:
         """
+        channel_order: "bgr" (cv2.imread) or "rgb" (PIL), see preprocess_image.
+        image may be None to reuse the backbone features of the image given to set_image.
+        Passing an image unsets the image given to set_image.
+
         import cv2
 
         image = cv2.imread(IMAGE_PATH)
@@ -174,15 +355,16 @@ class Model:
         box_annotator = sv.BoxAnnotator()
         annotated_image = box_annotator.annotate(scene=image, detections=detections, labels=labels)
         """
-        processed_image = Model.preprocess_image(image_bgr=image).to(self.device)
-        boxes, logits, phrases = predict(
-            model=self.model,
-            image=processed_image,
-            caption=caption,
-            box_threshold=box_threshold,
-            text_threshold=text_threshold, 
-            device=self.device)
-        source_h, source_w, _ = image.shape
+        processed_image, (source_h, source_w), unset_image_tensor = self._prepare_image(image, channel_order)
+        with self._autocast():
+            boxes, logits, phrases = predict(
+                model=self.model,
+                image=processed_image,
+                caption=caption,
+                box_threshold=box_threshold,
+                text_threshold=text_threshold, 
+                device=self.device,
+                unset_image_tensor=unset_image_tensor)
         detections = Model.post_process_result(
             source_h=source_h,
             source_w=source_w,
@@ -195,9 +377,17 @@ class Model:
         image: np.ndarray,
         classes: List[str],
         box_threshold: float,
-        text_threshold: float
+        text_threshold: float,
+        source_size: Tuple[int, int] = None,
+        channel_order: str = "bgr"
     ) -> sv.Detections:
         """
+        source_size: (h, w) the boxes are scaled to, when image is a downscaled copy of the
+        source (e.g. already resized with Model.get_input_size). Defaults to image.shape.
+        channel_order: "bgr" (cv2.imread) or "rgb" (PIL), see preprocess_image.
+        image may be None to reuse the backbone features of the image given to set_image.
+        Passing an image unsets the image given to set_image.
+
         import cv2
 
         image = cv2.imread(IMAGE_PATH)
@@ -217,15 +407,17 @@ class Model:
         annotated_image = box_annotator.annotate(scene=image, detections=detections)
         """
         caption = ". ".join(classes)
-        processed_image = Model.preprocess_image(image_bgr=image).to(self.device)
-        boxes, logits, phrases = predict(
-            model=self.model,
-            image=processed_image,
-            caption=caption,
-            box_threshold=box_threshold,
-            text_threshold=text_threshold,
-            device=self.device)
-        source_h, source_w, _ = image.shape
+        processed_image, image_size, unset_image_tensor = self._prepare_image(image, channel_order)
+        with self._autocast():
+            boxes, logits, phrases = predict(
+                model=self.model,
+                image=processed_image,
+                caption=caption,
+                box_threshold=box_threshold,
+                text_threshold=text_threshold,
+                device=self.device,
+                unset_image_tensor=unset_image_tensor)
+        source_h, source_w = source_size if source_size is not None else image_size
         detections = Model.post_process_result(
             source_h=source_h,
             source_w=source_w,
@@ -235,18 +427,103 @@ class Model:
         detections.class_id = class_id
         return detections
 
+    def predict_batch_with_classes(
+        self,
+        images: List[np.ndarray],
+        classes: List[str],
+        box_threshold: float,
+        text_threshold: float,
+        source_sizes: List[Tuple[int, int]] = None,
+        channel_order: str = "bgr"
+    ) -> List[sv.Detections]:
+        """
+        Same as predict_with_classes, but runs all images through GroundingDINO as one
+        padded batch. Returns one sv.Detections per input image, in order. Unsets the image
+        given to set_image.
+        """
+        self.unset_image()
+        if not images:
+            return []
+        if source_sizes is None:
+            source_sizes = [image.shape[:2] for image in images]
+        caption = ". ".join(classes)
+        processed_images = [
+            Model.preprocess_image(image=image, channel_order=channel_order, device=self.device)
+            for image in images
+        ]
+        chunk_size = self.static_batch_size or len(processed_images)
+        predictions = []
+        for start in range(0, len(processed_images), chunk_size):
+            chunk = processed_images[start:start + chunk_size]
+            # the fillers do not change the padded shape of the batch, their outputs are dropped below
+            chunk += chunk[-1:] * (chunk_size - len(chunk))
+            with self._autocast():
+                predictions += predict_batch(
+                    model=self.model,
+                    images=chunk,
+                    caption=caption,
+                    box_threshold=box_threshold,
+                    text_threshold=text_threshold,
+                    device=self.device,
+                    size_divisibility=self.size_divisibility)[:len(processed_images) - start]
+        detections_list = []
+        for (source_h, source_w), (boxes, logits, phrases) in zip(source_sizes, predictions):
+            detections = Model.post_process_result(
+                source_h=source_h,
+                source_w=source_w,
+                boxes=boxes,
+                logits=logits)
+            detections.class_id = Model.phrases2classes(phrases=phrases, classes=classes)
+            detections_list.append(detections)
+        return detections_list
+
     @staticmethod
-    def preprocess_image(image_bgr: np.ndarray) -> torch.Tensor:
-        transform = T.Compose(
-            [
-                T.RandomResize([800], max_size=1333),
-                T.ToTensor(),
-                T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-            ]
-        )
-        image_pillow = Image.fromarray(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))
-        image_transformed, _ = transform(image_pillow, None)
-        return image_transformed
+    def get_input_size(source_h: int, source_w: int, size: int = 800, max_size: int = 1333) -> Tuple[int, int]:
+        """(h, w) that preprocess_image resizes a source_h x source_w image to."""
+        return T.get_size_with_aspect_ratio((source_w, source_h), size, max_size)
+
+    @staticmethod
+    def preprocess_image(
+        image: Union[np.ndarray, torch.Tensor],
+        channel_order: str = "bgr",
+        device: str = "cpu",
+        size: int = 800,
+        max_size: int = 1333
+    ) -> torch.Tensor:
+        """
+        Resizes (shorter side to size, longer side at most max_size) and normalizes an
+        H x W x 3 uint8 image into a 3 x h x w float tensor on device, in RGB order.
+
+        channel_order is the order of the input channels, "bgr" (cv2.imread) or "rgb" (PIL).
+        The uint8 image is moved to device before any float work, and the resize and
+        normalization run as torch ops without going through PIL. CPU images bound for a
+        CUDA device are staged in pinned memory so the upload is asynchronous.
+        """
+        if channel_order not in ("bgr", "rgb"):
+            raise ValueError(f"channel_order must be 'bgr' or 'rgb', got {channel_order!r}")
+
+        if isinstance(image, np.ndarray):
+            image = torch.from_numpy(np.ascontiguousarray(image))
+        if image.dtype != torch.uint8 or image.dim() != 3 or image.shape[-1] != 3:
+            raise ValueError(f"Expected an H x W x 3 uint8 image, got {tuple(image.shape)} {image.dtype}")
+        if image.device.type == "cpu" and torch.device(device).type == "cuda":
+            image = image.pin_memory()
+        image = image.to(device, non_blocking=True).permute(2, 0, 1)
+        if channel_order == "bgr":
+            image = image.flip(0)
+        image = image.float()
+
+        source_h, source_w = image.shape[-2:]
+        target_h, target_w = Model.get_input_size(source_h, source_w, size, max_size)
+        if (target_h, target_w) != (source_h, source_w):
+            image = torch.nn.functional.interpolate(
+                image[None], size=(target_h, target_w), mode="bilinear", align_corners=False, antialias=True
+            )[0]
+
+        # ToTensor + Normalize as a single in-place affine map: (x / 255 - mean) / std
+        mean = torch.tensor(IMAGE_MEAN, device=image.device).view(3, 1, 1)
+        std = torch.tensor(IMAGE_STD, device=image.device).view(3, 1, 1)
+        return image.mul_(1.0 / (255.0 * std)).sub_(mean / std)
 
     @staticmethod
     def post_process_result(
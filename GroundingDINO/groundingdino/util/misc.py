@@ -396,10 +396,54 @@ def _max_by_axis(the_list):
     return maxes
 
 
+def is_compiling():
+    """True while torch.compile traces the caller. Caches holding tensors should not be
+    read or filled then: the compiled graph is specialized per shape anyway."""
+    compiler = getattr(torch, "compiler", None)
+    if compiler is not None and hasattr(compiler, "is_compiling"):
+        return bool(compiler.is_compiling())
+    # torch < 2.3
+    dynamo = getattr(torch, "_dynamo", None)
+    return bool(dynamo is not None and hasattr(dynamo, "is_compiling") and dynamo.is_compiling())
+
+
+class LRUCache(object):
+    """Keeps the values of the maxsize most recently used keys, for memoizing
+    inference-time values keyed by shapes, devices or inputs."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Returns the value of key and marks it as recently used, or None."""
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Stores value under key, evicting the least recently used entries, and returns it."""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class NestedTensor(object):
-    def __init__(self, tensors, mask: Optional[Tensor]):
+    def __init__(self, tensors, mask: Optional[Tensor], unpadded: Optional[bool] = None):
+        # unpadded: True if the mask is known to be all False, without reading it back from
+        # the device (see nested_tensor_from_tensor_list); None if unknown
         self.tensors = tensors
         self.mask = mask
+        self.unpadded = unpadded
         if mask == "auto":
             self.mask = torch.zeros_like(tensors).to(tensors.device)
             if self.mask.dim() == 3:
@@ -422,16 +466,16 @@ class NestedTensor(object):
             res.append(torch.Tensor([maxH, maxW]))
         return res
 
-    def to(self, device):
-        # type: (Device) -> NestedTensor # noqa
-        cast_tensor = self.tensors.to(device)
+    def to(self, device, non_blocking=False):
+        # type: (Device, bool) -> NestedTensor # noqa
+        cast_tensor = self.tensors.to(device, non_blocking=non_blocking)
         mask = self.mask
         if mask is not None:
             assert mask is not None
-            cast_mask = mask.to(device)
+            cast_mask = mask.to(device, non_blocking=non_blocking)
         else:
             cast_mask = None
-        return NestedTensor(cast_tensor, cast_mask)
+        return NestedTensor(cast_tensor, cast_mask, self.unpadded)
 
     def to_img_list_single(self, tensor, mask):
         assert tensor.dim() == 3, "dim of tensor should be 3 but {}".format(tensor.dim())
@@ -471,7 +515,9 @@ class NestedTensor(object):
         return {"tensors.shape": self.tensors.shape, "mask.shape": self.mask.shape}
 
 
-def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
+def nested_tensor_from_tensor_list(tensor_list: List[Tensor], size_divisibility: int = 0):
+    """size_divisibility: if > 0, pad height and width up to a multiple of it, so that inputs
+    fall into a small set of shapes (e.g. for torch.compile)."""
     # TODO make this more general
     if tensor_list[0].ndim == 3:
         if torchvision._is_tracing():
@@ -481,6 +527,8 @@ def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
 
         # TODO make it support different-sized images
         max_size = _max_by_axis([list(img.shape) for img in tensor_list])
+        if size_divisibility > 0:
+            max_size[1:] = [-(-size // size_divisibility) * size_divisibility for size in max_size[1:]]
         # min_size = tuple(min(s) for s in zip(*[img.shape for img in tensor_list]))
         batch_shape = [len(tensor_list)] + max_size
         b, c, h, w = batch_shape
@@ -491,9 +539,10 @@ def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
         for img, pad_img, m in zip(tensor_list, tensor, mask):
             pad_img[: img.shape[0], : img.shape[1], : img.shape[2]].copy_(img)
             m[: img.shape[1], : img.shape[2]] = False
+        unpadded = all(tuple(img.shape[1:]) == (h, w) for img in tensor_list)
     else:
         raise ValueError("not supported")
-    return NestedTensor(tensor, mask)
+    return NestedTensor(tensor, mask, unpadded)
 
 
 # _onnx_nested_tensor_from_tensor_list() is an implementation of
@@ -80,8 +80,14 @@ def get_extensions():
     extension = CppExtension
 
     extra_compile_args = {"cxx": []}
+    extra_link_args = []
     define_macros = []
 
+    if sys.platform.startswith("linux"):
+        # the CPU kernel uses at::parallel_for, which only runs multi-threaded when built with OpenMP
+        extra_compile_args["cxx"] += ["-fopenmp"]
+        extra_link_args += ["-fopenmp"]
+
     if CUDA_HOME is not None and (torch.cuda.is_available() or "TORCH_CUDA_ARCH_LIST" in os.environ):
         print("Compiling with CUDA")
         extension = CUDAExtension
@@ -97,7 +103,6 @@ def get_extensions():
         print("Compiling without CUDA")
         define_macros += [("WITH_HIP", None)]
         extra_compile_args["nvcc"] = []
-        return None
 
     sources = [os.path.join(extensions_dir, s) for s in sources]
     include_dirs = [extensions_dir]
@@ -109,6 +114,7 @@ def get_extensions():
             include_dirs=include_dirs,
             define_macros=define_macros,
             extra_compile_args=extra_compile_args,
+            extra_link_args=extra_link_args,
         )
     ]
 
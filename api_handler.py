@@ -247,129 +247,430 @@
 
 
 # api_handler.py
-from settings import BOX_TRESHOLD, TEXT_TRESHOLD, CLASSES
+from settings import (
+    BOX_TRESHOLD, TEXT_TRESHOLD, CLASSES, SAM_BOX_BATCH_SIZE, DINO_BATCH_SIZE, INGEST_DRAFT_SIZE,
+    OUTPUT_FORMAT, PNG_COMPRESSION, OUTPUT_QUALITY, ENCODE_WORKERS, PIPELINE_STAGE_WORKERS, PIPELINE_QUEUE_SIZE,
+    SAM_GATE_MIN_SCORE, SAM_GATE_MAX_BOXES, SAM_GATE_MIN_AREA,
+)
 from segment_anything import SamPredictor
+from segment_anything.utils.transforms import ResizeLongestSide
 import numpy as np
+import torch
 import cv2
 from PIL import Image
-import os, base64
+import base64
 import io
-
-# --- Segmentation Function (no changes needed) ---
-def segment(sam_predictor: SamPredictor, image: np.ndarray, xyxy: np.ndarray) -> np.ndarray:
-    sam_predictor.set_image(image)
-    result_masks = []
-    for box in xyxy:
-        masks, scores, logits = sam_predictor.predict(box=box, multimask_output=True)
-        index = np.argmax(scores)
-        result_masks.append(masks[index])
-    return np.array(result_masks)
-
-# --- Slicing Function (no changes needed) ---
-def slice_image_using_mask(original_image, mask, target_size=(1024, 1024)):
-    mask = np.asarray(mask)
-    if mask.dtype == bool:
-        mask_uint8 = np.uint8(mask) * 255
-    elif mask.dtype == np.uint8:
-        mask_uint8 = np.where(mask > 0, 255, 0).astype(np.uint8)
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from utilities.debug_sink import DEBUG_SINK
+from utilities.pipeline import StagedPipeline, Stage
+from utilities.embedding_cache import EmbeddingCache, SAM_EMBEDDING_CACHE
+
+# --- Segmentation Function ---
+def set_sam_image(sam_predictor: SamPredictor, image: np.ndarray, sam_image: np.ndarray = None,
+                  embedding_cache: EmbeddingCache = SAM_EMBEDDING_CACHE):
+    # Runs the SAM image encoder unless the embedding of this exact input is cached.
+    # sam_image: optional copy of image already resized to the encoder size (see ingest_image).
+    h, w = image.shape[:2]
+    key = None
+    if embedding_cache.enabled:
+        key = EmbeddingCache.key(sam_image if sam_image is not None else image, (h, w))
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            sam_predictor.reset_image()
+            sam_predictor.features = cached.features.to(sam_predictor.device, dtype=torch.float32)
+            sam_predictor.original_size = cached.original_size
+            sam_predictor.input_size = cached.input_size
+            sam_predictor.is_image_set = True
+            print("DEBUG: Reusing cached SAM image embedding.")
+            return
+
+    if sam_image is None:
+        sam_predictor.set_image(image)
     else:
+        input_image_torch = torch.as_tensor(sam_image, device=sam_predictor.device)
+        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+        sam_predictor.set_torch_image(input_image_torch, (h, w))
+
+    if key is not None:
+        embedding_cache.put(key, sam_predictor.features, sam_predictor.original_size, sam_predictor.input_size)
+
+
+def segment(sam_predictor: SamPredictor, image: np.ndarray, xyxy: np.ndarray, box_batch_size: int = SAM_BOX_BATCH_SIZE,
+            sam_image: np.ndarray = None) -> np.ndarray:
+    # sam_image: optional copy of image already resized to the encoder size (see ingest_image),
+    # masks are still returned at the resolution of image.
+    h, w = image.shape[:2]
+    set_sam_image(sam_predictor, image, sam_image)
+    if len(xyxy) == 0:
+        return np.zeros((0, h, w), dtype=bool)
+
+    # All boxes go through the prompt encoder / mask decoder together, in chunks of
+    # box_batch_size. This is SamPredictor.predict_torch, except that the best of the 3
+    # low-res (256 x 256) masks is picked before upscaling, so only a (B, 1, H, W) float
+    # tensor is ever allocated at full resolution instead of (B, 3, H, W).
+    sam = sam_predictor.model
+    boxes = torch.as_tensor(np.asarray(xyxy, dtype=np.float32), device=sam_predictor.device)
+    boxes = sam_predictor.transform.apply_boxes_torch(boxes, (h, w))
+    result_masks = np.empty((len(xyxy), h, w), dtype=bool)
+    with torch.inference_mode():
+        for start in range(0, len(boxes), box_batch_size):
+            sparse_embeddings, dense_embeddings = sam.prompt_encoder(
+                points=None,
+                boxes=boxes[start : start + box_batch_size],
+                masks=None,
+            )
+            low_res_masks, scores = sam.mask_decoder(
+                image_embeddings=sam_predictor.features,
+                image_pe=sam.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=True,
+            )
+            best = scores.argmax(dim=1)
+            best_logits = low_res_masks[torch.arange(len(best), device=low_res_masks.device), best]
+            masks = sam.postprocess_masks(
+                best_logits[:, None], sam_predictor.input_size, sam_predictor.original_size
+            )
+            result_masks[start : start + len(best)] = (masks[:, 0] > sam.mask_threshold).cpu().numpy()
+    return result_masks
+
+# --- Slicing Function ---
+def slice_image_using_mask(original_image, mask, target_size=(1024, 1024), out=None):
+    # Works on the mask's bounding-box ROI only, so the cost scales with the object, not the image.
+    # `out` may be a reusable (target_h, target_w, 3) uint8 canvas; it is overwritten and returned.
+    mask = np.asarray(mask)
+    if mask.dtype == np.uint8:
+        mask = mask > 0
+    elif mask.dtype != bool:
         raise ValueError(f"Unsupported mask dtype: {mask.dtype}. Expected bool or uint8.")
-    mask_uint8 = np.ascontiguousarray(mask_uint8)
 
-    if original_image.shape[:2] != mask_uint8.shape[:2]:
-        raise ValueError(f"Dimension mismatch: Original image shape {original_image.shape[:2]} != Mask shape {mask_uint8.shape[:2]}")
+    if original_image.shape[:2] != mask.shape[:2]:
+        raise ValueError(f"Dimension mismatch: Original image shape {original_image.shape[:2]} != Mask shape {mask.shape[:2]}")
 
-    try:
-        original_image_contiguous = np.ascontiguousarray(original_image)
-        object_only = cv2.bitwise_and(original_image_contiguous, original_image_contiguous, mask=mask_uint8)
-    except cv2.error as e:
-        print(f"ERROR in cv2.bitwise_and: img_shape={original_image.shape}, mask_shape={mask_uint8.shape}, error={e}")
-        raise
+    target_w, target_h = target_size
+    if out is None:
+        result_image = np.empty((target_h, target_w, 3), dtype=np.uint8)
+    else:
+        result_image = out
+    result_image.fill(255)
 
-    coords = cv2.findNonZero(mask_uint8)
-    if coords is None:
+    x, y, w, h = mask_bbox(mask)
+    if w == 0 or h == 0:
         print("WARN: Empty mask encountered in slice_image_using_mask. Returning blank image.")
-        return np.ones((target_size[1], target_size[0], 3), dtype=np.uint8) * 255
+        return result_image
 
-    x, y, w, h = cv2.boundingRect(coords)
-    cropped_object = object_only[y : y + h, x : x + w]
-    cropped_mask_uint8 = mask_uint8[y : y + h, x : x + w]
+    cropped_mask_uint8 = np.ascontiguousarray(mask[y : y + h, x : x + w], dtype=np.uint8) * np.uint8(255)
+    try:
+        cropped_image = np.ascontiguousarray(original_image[y : y + h, x : x + w])
+        cropped_object = cv2.bitwise_and(cropped_image, cropped_image, mask=cropped_mask_uint8)
+    except cv2.error as e:
+        print(f"ERROR in cv2.bitwise_and: img_shape={original_image.shape}, mask_shape={mask.shape}, error={e}")
+        raise
 
-    target_w, target_h = target_size
-    scale = min(target_w / w, target_h / h) if w > 0 and h > 0 else 1
+    scale = min(target_w / w, target_h / h)
     new_w, new_h = int(w * scale), int(h * scale)
     new_w, new_h = max(1, new_w), max(1, new_h)
 
     resized_object = cv2.resize(cropped_object, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
     resized_mask_uint8 = cv2.resize(cropped_mask_uint8, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
-    resized_mask_uint8 = np.where(resized_mask_uint8 > 0, 255, 0).astype(np.uint8)
 
-    result_image = np.ones((target_h, target_w, 3), dtype=np.uint8) * 255
     x_offset = (target_w - new_w) // 2
     y_offset = (target_h - new_h) // 2
-    mask_for_placement = resized_mask_uint8[:, :, np.newaxis] > 0
-
-    result_image[y_offset : y_offset + new_h, x_offset : x_offset + new_w] = np.where(
-        mask_for_placement,
+    np.copyto(
+        result_image[y_offset : y_offset + new_h, x_offset : x_offset + new_w],
         resized_object,
-        result_image[y_offset : y_offset + new_h, x_offset : x_offset + new_w]
+        where=resized_mask_uint8[:, :, np.newaxis] > 0,
     )
     return result_image
 
 
-# --- Main Detection and Segmentation Function ---
-# <<< Added batch_index parameter >>>
-def detect_and_segment_object(image_input, grounding_dino_model, sam_predictor, batch_index: int = 0):
+# --- Output Encoding Functions ---
+IMAGE_EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+OUTPUT_FORMATS = tuple(IMAGE_EXTENSIONS) + ("rle",)
+ENCODE_EXECUTOR = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+
+
+def parse_output_format(spec=None) -> dict:
     """
-    Detects, segments, extracts objects from ONE image, saves debug files with batch index.
+    Normalizes the handler's output_format option.
 
-    Args:
-        image_input: File-like object (e.g., io.BytesIO) containing the image data.
-        grounding_dino_model: Initialized GroundingDINO model instance.
-        sam_predictor: Initialized SAM predictor instance.
-        batch_index: Index of the image within the current batch (for unique debug filenames).
+    Accepts None (server default), a format name ("png", "webp", "jpeg", "rle") or a dict such as
+    {"format": "webp", "quality": 90, "lossless": False}, {"format": "png", "compression": 1}
+    or {"format": "rle", "compressed": False}.
+    """
+    if spec is None:
+        spec = OUTPUT_FORMAT
+    if isinstance(spec, str):
+        spec = {"format": spec}
+    if not isinstance(spec, dict):
+        raise ValueError(f"Unsupported output_format: {spec!r}")
+
+    fmt = str(spec.get("format", OUTPUT_FORMAT)).lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {fmt}. Expected one of {OUTPUT_FORMATS}.")
+    # out of range values would only fail in cv2.imencode, per detection, where the error
+    # is logged and the detection dropped; reject them here so the client sees the error
+    compression = int(spec.get("compression", PNG_COMPRESSION))
+    if not 0 <= compression <= 9:
+        raise ValueError(f"Unsupported PNG compression: {compression}. Expected 0-9.")
+    quality = int(spec.get("quality", OUTPUT_QUALITY))
+    if not 0 <= quality <= 100:
+        raise ValueError(f"Unsupported quality: {quality}. Expected 0-100.")
+    return {
+        "format": fmt,
+        "compression": compression,
+        "quality": quality,
+        "lossless": bool(spec.get("lossless", False)),
+        "compressed": bool(spec.get("compressed", True)),
+    }
+
+
+def encode_image(image_bgr: np.ndarray, output_format: dict):
+    """Encodes a BGR image with cv2.imencode according to a parsed output_format."""
+    fmt = output_format["format"]
+    if fmt == "png":
+        params = [int(cv2.IMWRITE_PNG_COMPRESSION), output_format["compression"]]
+    elif fmt == "webp":
+        # OpenCV switches WebP to lossless for quality > 100
+        params = [int(cv2.IMWRITE_WEBP_QUALITY), 101 if output_format["lossless"] else output_format["quality"]]
+    elif fmt == "jpeg":
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), output_format["quality"]]
+    else:
+        raise ValueError(f"Cannot encode an image to {fmt}.")
+    return cv2.imencode(IMAGE_EXTENSIONS[fmt], image_bgr, params)
+
+
+def rle_counts_to_string(counts) -> str:
+    """Compresses RLE counts into the COCO (pycocotools) string format."""
+    chars = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def mask_bbox(mask: np.ndarray) -> list:
+    """Tight [x, y, w, h] box around the True pixels of a mask, [0, 0, 0, 0] if it is empty."""
+    mask = np.asarray(mask, dtype=bool)
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return [0, 0, 0, 0]
+    return [int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)]
+
+
+def mask_to_rle(mask: np.ndarray, compressed: bool = True) -> dict:
+    """
+    Encodes a boolean mask as COCO-style RLE (column-major, starting with a run of zeros).
+
+    Only the columns spanned by the object are scanned; the empty columns around it are
+    folded into the first and last runs. With compressed=True the counts are returned as
+    the pycocotools string, otherwise as a list of ints.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    h, w = mask.shape[:2]
+    cols = np.flatnonzero(mask.any(axis=0))
+    if cols.size == 0:
+        counts = [h * w] if h * w else []
+    else:
+        x0, x1 = int(cols[0]), int(cols[-1]) + 1
+        flat = mask[:, x0:x1].ravel(order="F")
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        counts = np.diff(np.concatenate(([0], changes, [flat.size]))).tolist()
+        if flat[0]:
+            counts = [0] + counts
+        counts[0] += x0 * h
+        trailing = (w - x1) * h
+        if trailing and flat[-1]:
+            counts.append(trailing)
+        elif trailing:
+            counts[-1] += trailing
+    return {"size": [h, w], "counts": rle_counts_to_string(counts) if compressed else counts}
+
+
+_CANVASES = threading.local()
+
+
+def _thread_canvases(target_size=(1024, 1024)) -> dict:
+    """Per-thread output canvases reused by encode_detection across detections and requests."""
+    canvases = getattr(_CANVASES, "canvases", None)
+    if canvases is None or canvases["rgb"].shape[:2] != (target_size[1], target_size[0]):
+        shape = (target_size[1], target_size[0], 3)
+        canvases = {"rgb": np.empty(shape, dtype=np.uint8), "bgr": np.empty(shape, dtype=np.uint8)}
+        _CANVASES.canvases = canvases
+    return canvases
+
+
+def encode_detection(image_np_rgb: np.ndarray, mask: np.ndarray, output_format: dict, batch_index: int = 0, detection_index: int = 0,
+                     score=None, class_id=None):
+    """
+    Produces the response entry of ONE detection.
 
     Returns:
-        A list of base64 encoded strings, each representing a segmented object image (PNG).
-        Returns an empty list if no objects are detected.
+        (result, buffer): result is a base64 string for image formats, or for "rle" a
+        {"bbox", "score", "class_id", "rle"} dict that leaves compositing to the client;
+        buffer is the encoded image (None for "rle"). result is None if the detection failed.
+    """
+    print(f"DEBUG (Batch {batch_index}, Detection {detection_index}): Processing detection. Mask shape: {mask.shape}, dtype: {mask.dtype}")
+    try:
+        if output_format["format"] == "rle":
+            return {
+                "bbox": mask_bbox(mask),
+                "score": None if score is None else float(score),
+                "class_id": None if class_id is None else int(class_id),
+                "rle": mask_to_rle(mask, compressed=output_format["compressed"]),
+            }, None
+
+        canvases = _thread_canvases()
+        seg_img_rgb = slice_image_using_mask(image_np_rgb, mask, out=canvases["rgb"])
+        seg_img_bgr = cv2.cvtColor(seg_img_rgb, cv2.COLOR_RGB2BGR, dst=canvases["bgr"])
+        print(f"DEBUG (Batch {batch_index}, Detection {detection_index}): Sliced seg_img_bgr shape: {seg_img_bgr.shape}, dtype: {seg_img_bgr.dtype}")
+
+        # --- Encode to the requested format ---
+        success, seg_buffer = encode_image(seg_img_bgr, output_format)
+        if not success:
+            print(f"ERROR (Batch {batch_index}, Detection {detection_index}): Failed to encode image to {output_format['format'].upper()} format.")
+            return None, None
+
+        # --- Encode buffer to Base64 ---
+        return base64.b64encode(seg_buffer).decode("utf-8"), seg_buffer
+
+    except ValueError as ve:
+        print(f"ERROR (Batch {batch_index}, Detection {detection_index}): ValueError during slicing: {ve}")
+    except cv2.error as cv_err:
+        print(f"ERROR (Batch {batch_index}, Detection {detection_index}): OpenCV error during processing: {cv_err}")
+    except Exception as e:
+        print(f"ERROR (Batch {batch_index}, Detection {detection_index}): Unexpected error: {e}")
+    return None, None
+
+
+# --- Image Loading Functions ---
+class IngestedImage(NamedTuple):
+    original: np.ndarray  # decoded RGB image (at the draft scale, see load_image_rgb), used for the final cropping
+    dino: np.ndarray  # RGB resized to the GroundingDINO input size
+    sam: np.ndarray  # RGB resized so its longest side is the SAM encoder size
+
+
+def load_image_rgb(image_input, batch_index: int = 0, draft_size: int = INGEST_DRAFT_SIZE) -> np.ndarray:
     """
-    print(f"DEBUG (Batch {batch_index}): Received image_input of type {type(image_input)}")
+    Decodes a file-like image into an RGB NumPy array.
 
-    # --- Image Loading and Preparation ---
+    With draft_size > 0, JPEGs are decoded at the smallest DCT scale (1/2, 1/4, 1/8) whose
+    shorter side is still at least draft_size pixels. The full-resolution image is never
+    decoded then, so the masks and crops are at that reduced scale too.
+    """
     try:
-        img_pil = Image.open(image_input).convert("RGB")
-        image_np_rgb = np.array(img_pil)
+        img_pil = Image.open(image_input)
+        if draft_size:
+            img_pil.draft("RGB", (draft_size, draft_size))
+        # np.array, not np.asarray: the latter is read-only and torch.from_numpy warns on it
+        image_np_rgb = np.array(img_pil.convert("RGB"))
     except Exception as e:
         print(f"ERROR (Batch {batch_index}): Failed to load or convert image: {e}")
         raise
 
     print(f"DEBUG (Batch {batch_index}): Loaded image_np_rgb shape: {image_np_rgb.shape}, dtype: {image_np_rgb.dtype}")
+    return image_np_rgb
 
-    # --- Object Detection ---
-    try:
-        detections = grounding_dino_model.predict_with_classes(
-            image=image_np_rgb,
-            classes=CLASSES,
-            box_threshold=BOX_TRESHOLD,
-            text_threshold=TEXT_TRESHOLD,
-        )
-    except Exception as e:
-        print(f"ERROR (Batch {batch_index}): GroundingDINO prediction failed: {e}")
-        raise
 
+def _resize_rgb(image: np.ndarray, size_hw) -> np.ndarray:
+    h, w = size_hw
+    if image.shape[:2] == (h, w):
+        return image
+    interpolation = cv2.INTER_AREA if h * w < image.shape[0] * image.shape[1] else cv2.INTER_LINEAR
+    return cv2.resize(image, (w, h), interpolation=interpolation)
+
+
+def ingest_image(image_input, grounding_dino_model, sam_predictor, batch_index: int = 0) -> IngestedImage:
+    """
+    Decodes an image once and derives the GroundingDINO and SAM inputs from that buffer.
+
+    The full-resolution image is resized a single time, to the larger of the two model
+    inputs, and the smaller input is then derived from that copy.
+    """
+    image_np_rgb = load_image_rgb(image_input, batch_index)
+    h, w = image_np_rgb.shape[:2]
+    dino_size = grounding_dino_model.get_input_size(h, w)
+    sam_size = ResizeLongestSide.get_preprocess_shape(h, w, sam_predictor.transform.target_length)
+
+    if dino_size[0] * dino_size[1] >= sam_size[0] * sam_size[1]:
+        dino_image = _resize_rgb(image_np_rgb, dino_size)
+        sam_image = _resize_rgb(dino_image, sam_size)
+    else:
+        sam_image = _resize_rgb(image_np_rgb, sam_size)
+        dino_image = _resize_rgb(sam_image, dino_size)
+    return IngestedImage(original=image_np_rgb, dino=dino_image, sam=sam_image)
+
+
+# --- Segmentation and Encoding Functions ---
+def gate_detections(detections, image_shape, batch_index: int = 0,
+                    min_score: float = SAM_GATE_MIN_SCORE, max_boxes: int = SAM_GATE_MAX_BOXES,
+                    min_area: float = SAM_GATE_MIN_AREA):
+    """
+    Drops the detections not worth segmenting: confidence below min_score, box area below
+    min_area (fraction of the image area), and all but the max_boxes highest scoring ones.
+    Returns the kept detections (all their fields indexed together), or detections itself
+    when nothing is dropped.
+    """
+    if len(detections.xyxy) == 0:
+        return detections
+
+    image_h, image_w = image_shape[:2]
+    xyxy = detections.xyxy
+    areas = np.clip(xyxy[:, 2] - xyxy[:, 0], 0, None) * np.clip(xyxy[:, 3] - xyxy[:, 1], 0, None)
+    keep = areas >= min_area * image_h * image_w
+    if detections.confidence is not None:
+        keep &= detections.confidence >= min_score
+    keep = np.flatnonzero(keep)
+    if max_boxes > 0 and len(keep) > max_boxes:
+        if detections.confidence is not None:
+            keep = keep[np.argsort(-detections.confidence[keep], kind="stable")]
+        keep = np.sort(keep[:max_boxes])
+
+    if len(keep) < len(xyxy):
+        print(f"DEBUG (Batch {batch_index}): SAM gate dropped {len(xyxy) - len(keep)} of {len(xyxy)} detections.")
+        detections = detections[keep]
+    return detections
+
+
+def segment_detections(image_np_rgb: np.ndarray, detections, sam_predictor, batch_index: int = 0, sam_image: np.ndarray = None):
+    """
+    Segments the detections of ONE image with SAM and returns them with their masks in .mask.
+    sam_image is the optional pre-resized SAM input of image_np_rgb, see ingest_image.
+    Detections failing the SAM gate (see gate_detections) are removed first.
+    """
     # --- Handle No Detections ---
     if len(detections.xyxy) == 0:
         print(f"INFO (Batch {batch_index}): No objects detected matching the criteria.")
-        return []
+        return detections
 
     print(f"DEBUG (Batch {batch_index}): Found {len(detections.xyxy)} initial detections.")
 
+    # --- SAM Gate (skips the image encoder when nothing survives) ---
+    detections = gate_detections(detections, image_np_rgb.shape, batch_index)
+    if len(detections.xyxy) == 0:
+        print(f"INFO (Batch {batch_index}): No detections passed the SAM gate.")
+        return detections
+
     # --- Object Segmentation ---
     try:
         detections.mask = segment(
             sam_predictor=sam_predictor,
             image=image_np_rgb,
             xyxy=detections.xyxy,
+            sam_image=sam_image,
         )
         print(f"DEBUG (Batch {batch_index}): Generated {len(detections.mask)} masks.")
         if len(detections.mask) != len(detections.xyxy):
@@ -377,69 +678,182 @@ def detect_and_segment_object(image_input, grounding_dino_model, sam_predictor,
     except Exception as e:
         print(f"ERROR (Batch {batch_index}): SAM segmentation failed: {e}")
         raise
+    return detections
+
+
+def encode_detections(image_np_rgb: np.ndarray, detections, batch_index: int = 0, output_format: dict = None):
+    """
+    Extracts and encodes every segmented detection of ONE image.
+
+    Returns:
+        A list with one entry per object: a base64 encoded image (PNG by default), or a
+        {"bbox", "score", "class_id", "rle"} dict when output_format is "rle".
+        Returns an empty list if there are no detections.
+    """
+    output_format = parse_output_format(output_format)
+    if len(detections.xyxy) == 0 or detections.mask is None:
+        return []
 
     # --- Slicing, Encoding, and Saving ---
+    # Each detection is sliced and encoded on the encode pool (OpenCV releases the GIL).
     sliced_images_b64 = []
-    os.makedirs("debug/img", exist_ok=True)
-    os.makedirs("debug/b64", exist_ok=True)
-
-    # Use detection_index for clarity within the image processing loop
+    save_debug = DEBUG_SINK.sample()
+    # unique per call, so that requests (and concurrent ones) don't overwrite each other's artifacts
+    debug_prefix = uuid.uuid4().hex[:12]
+    futures = []
     for detection_index in range(len(detections)):
         if detection_index >= len(detections.mask):
             print(f"WARN (Batch {batch_index}): Skipping detection {detection_index} due to missing mask.")
             continue
+        futures.append((detection_index, ENCODE_EXECUTOR.submit(
+            encode_detection, image_np_rgb, detections.mask[detection_index], output_format, batch_index, detection_index,
+            score=detections.confidence[detection_index] if detections.confidence is not None else None,
+            class_id=detections.class_id[detection_index] if detections.class_id is not None else None,
+        )))
+
+    for detection_index, future in futures:
+        result, seg_buffer = future.result()
+        if result is None:
+            continue
+        sliced_images_b64.append(result)
+
+        # --- Queue debug files (written in the background, see utilities/debug_sink.py) ---
+        if save_debug and seg_buffer is not None:
+            base_filename = f"{debug_prefix}_batch_{batch_index}_detection_{detection_index}"
+            DEBUG_SINK.submit(f"b64/{base_filename}.b64", result.encode("utf-8"))
+            DEBUG_SINK.submit(f"img/{base_filename}{IMAGE_EXTENSIONS[output_format['format']]}", seg_buffer.tobytes())
+
+    print(f"DEBUG (Batch {batch_index}): Finished processing image. Returning {len(sliced_images_b64)} encoded objects.")
+    return sliced_images_b64
+
+
+def segment_and_encode(image_np_rgb: np.ndarray, detections, sam_predictor, batch_index: int = 0, output_format: dict = None,
+                       sam_image: np.ndarray = None):
+    """Segments the detections of ONE image with SAM, extracts each object and encodes it (see encode_detections)."""
+    detections = segment_detections(image_np_rgb, detections, sam_predictor, batch_index, sam_image)
+    return encode_detections(image_np_rgb, detections, batch_index, output_format)
+
+
+# --- Pipeline ---
+_PIPELINE = None
+_PIPELINE_MODELS = None
+_PIPELINE_LOCK = threading.Lock()
+
+
+def build_pipeline(grounding_dino_model, sam_predictor) -> StagedPipeline:
+    """
+    Builds the ingest -> detect -> segment -> encode pipeline.
 
-        mask = detections.mask[detection_index]
-        print(f"DEBUG (Batch {batch_index}, Detection {detection_index}): Processing detection. Mask shape: {mask.shape}, dtype: {mask.dtype}")
+    Each submitted job is a dict with "image_input", "batch_index" and "output_format";
+    its future resolves to the list returned by encode_detections. The detect stage
+    batches up to DINO_BATCH_SIZE queued images into one padded GroundingDINO pass.
+    """
+    def ingest(job):
+        print(f"DEBUG (Batch {job['batch_index']}): Received image_input of type {type(job['image_input'])}")
+        job["image"] = ingest_image(job["image_input"], grounding_dino_model, sam_predictor, job["batch_index"])
+        return job
 
+    def detect(jobs):
         try:
-            seg_img_rgb = slice_image_using_mask(image_np_rgb, mask)
-            seg_img_bgr = cv2.cvtColor(seg_img_rgb, cv2.COLOR_RGB2BGR)
-            print(f"DEBUG (Batch {batch_index}, Detection {detection_index}): Sliced seg_img_bgr shape: {seg_img_bgr.shape}, dtype: {seg_img_bgr.dtype}")
-
-            # --- Encode to PNG ---
-            encode_params = [int(cv2.IMWRITE_PNG_COMPRESSION), 9]
-            success, seg_buffer = cv2.imencode('.png', seg_img_bgr, encode_params)
-            if not success:
-                print(f"ERROR (Batch {batch_index}, Detection {detection_index}): Failed to encode image to PNG format.")
-                continue
-
-            # --- Encode buffer to Base64 ---
-            b64_string = base64.b64encode(seg_buffer).decode("utf-8")
-            sliced_images_b64.append(b64_string)
-
-            # --- Define unique debug filenames using batch_index and detection_index --- # <<< UPDATED
-            base_filename = f"batch_{batch_index}_detection_{detection_index}"
-            b64_filename = f"debug/b64/{base_filename}.b64"
-            debug_img_filename = f"debug/img/{base_filename}.png"
-
-            # --- Save Base64 string ---
-            try:
-                with open(b64_filename, 'w', encoding='utf-8') as f_b64:
-                    f_b64.write(b64_string)
-                print(f"DEBUG (Batch {batch_index}, Detection {detection_index}): Saved base64 string to: {b64_filename}")
-            except IOError as io_err:
-                print(f"WARN (Batch {batch_index}, Detection {detection_index}): Failed to save base64 string to {b64_filename}: {io_err}")
-
-            # --- Save debug image (PNG) ---
-            save_success = cv2.imwrite(debug_img_filename, seg_img_bgr)
-            if save_success:
-                print(f"DEBUG (Batch {batch_index}, Detection {detection_index}): Saved debug image: {debug_img_filename}")
-            else:
-                print(f"WARN (Batch {batch_index}, Detection {detection_index}): Failed to save debug image: {debug_img_filename}")
-
-        except ValueError as ve:
-            print(f"ERROR (Batch {batch_index}, Detection {detection_index}): ValueError during slicing: {ve}")
-            continue
-        except cv2.error as cv_err:
-             print(f"ERROR (Batch {batch_index}, Detection {detection_index}): OpenCV error during processing: {cv_err}")
-             continue
+            detections_list = grounding_dino_model.predict_batch_with_classes(
+                images=[job["image"].dino for job in jobs],
+                classes=CLASSES,
+                box_threshold=BOX_TRESHOLD,
+                text_threshold=TEXT_TRESHOLD,
+                source_sizes=[job["image"].original.shape[:2] for job in jobs],
+                channel_order="rgb",
+            )
         except Exception as e:
-            print(f"ERROR (Batch {batch_index}, Detection {detection_index}): Unexpected error: {e}")
-            continue
+            print(f"ERROR (Batch {', '.join(str(job['batch_index']) for job in jobs)}): GroundingDINO prediction failed: {e}")
+            raise
+        for job, detections in zip(jobs, detections_list):
+            job["detections"] = detections
+        return jobs
+
+    def segment_stage(job):
+        image = job["image"]
+        job["detections"] = segment_detections(image.original, job["detections"], sam_predictor, job["batch_index"], image.sam)
+        return job
+
+    def encode(job):
+        return encode_detections(job["image"].original, job["detections"], job["batch_index"], job["output_format"])
+
+    return StagedPipeline(
+        [
+            Stage("ingest", ingest, PIPELINE_STAGE_WORKERS["ingest"]),
+            Stage("detect", detect, PIPELINE_STAGE_WORKERS["detect"], batch_size=DINO_BATCH_SIZE),
+            Stage("segment", segment_stage, PIPELINE_STAGE_WORKERS["segment"]),
+            Stage("encode", encode, PIPELINE_STAGE_WORKERS["encode"]),
+        ],
+        queue_size=PIPELINE_QUEUE_SIZE,
+    )
 
-    print(f"DEBUG (Batch {batch_index}): Finished processing image. Returning {len(sliced_images_b64)} base64 encoded objects.")
-    return sliced_images_b64
+
+def get_pipeline(grounding_dino_model, sam_predictor) -> StagedPipeline:
+    """Returns the process-wide pipeline for these models, shared by all concurrent requests."""
+    global _PIPELINE, _PIPELINE_MODELS
+    with _PIPELINE_LOCK:
+        if _PIPELINE is None or _PIPELINE_MODELS != (id(grounding_dino_model), id(sam_predictor)):
+            _PIPELINE = build_pipeline(grounding_dino_model, sam_predictor)
+            _PIPELINE_MODELS = (id(grounding_dino_model), id(sam_predictor))
+        return _PIPELINE
+
+
+# --- Main Detection and Segmentation Functions ---
+def detect_and_segment_object(image_input, grounding_dino_model, sam_predictor, batch_index: int = 0, output_format=None):
+    """
+    Detects, segments, extracts objects from ONE image, saves debug files with batch index.
+
+    Args:
+        image_input: File-like object (e.g., io.BytesIO) containing the image data.
+        grounding_dino_model: Initialized GroundingDINO model instance.
+        sam_predictor: Initialized SAM predictor instance.
+        batch_index: Index of the image within the current batch (for unique debug filenames).
+        output_format: Encoding of each object, see parse_output_format. Defaults to settings.OUTPUT_FORMAT.
+
+    Returns:
+        A list of encoded objects, by default base64 encoded strings, each representing a segmented object image (PNG).
+        Returns an empty list if no objects are detected.
+    """
+    job = {"image_input": image_input, "batch_index": batch_index, "output_format": parse_output_format(output_format)}
+    return get_pipeline(grounding_dino_model, sam_predictor).submit(job).result()
+
+
+def detect_and_segment_objects(image_inputs, grounding_dino_model, sam_predictor, output_format=None):
+    """
+    Detects, segments, extracts objects from SEVERAL images.
+
+    All images are submitted to the pipeline at once, so decoding, GroundingDINO (on
+    padded batches of up to DINO_BATCH_SIZE images), SAM and encoding of different
+    images overlap.
+
+    Args:
+        image_inputs: List of file-like objects (e.g., io.BytesIO) containing the image data.
+        grounding_dino_model: Initialized GroundingDINO model instance.
+        sam_predictor: Initialized SAM predictor instance.
+        output_format: Encoding of each object, see parse_output_format. Defaults to settings.OUTPUT_FORMAT.
+
+    Returns:
+        A list with one entry per input image, each a list of encoded objects (base64 PNG by default),
+        or {"error": ..., "details": ...} for an image that failed, so that the other images of
+        the batch are still returned.
+    """
+    output_format = parse_output_format(output_format)
+    print(f"DEBUG: Received batch of {len(image_inputs)} images.")
+
+    pipeline = get_pipeline(grounding_dino_model, sam_predictor)
+    futures = [
+        pipeline.submit({"image_input": image_input, "batch_index": batch_index, "output_format": output_format})
+        for batch_index, image_input in enumerate(image_inputs)
+    ]
+    results = []
+    for batch_index, future in enumerate(futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            print(f"ERROR (Batch {batch_index}): Processing failed: {e}")
+            results.append({"error": "Exception occurred", "details": str(e)})
+    return results
 
 # (Example Usage Placeholder remains the same)
 # if __name__ == "__main__":
@@ -3,6 +3,10 @@
 from settings import (
     GROUNDING_DINO_CONFIG_PATH,
     GROUNDING_DINO_CHECKPOINT_PATH,
+    GROUNDING_DINO_PRECISION,
+    GROUNDING_DINO_STATIC_SHAPES,
+    GROUNDING_DINO_COMPILE,
+    DINO_BATCH_SIZE,
     SAM_ENCODER_VERSION,
     SAM_CHECKPOINT_PATH,
     SAM_DEVICE,
@@ -35,6 +39,10 @@ class KuberaModel:
             self.GROUNDING_DINO_MODEL = Model(
                 model_config_path=self.grounding_dino_config_path,
                 model_checkpoint_path=self.grounding_dino_checkpoint_path,
+                precision=GROUNDING_DINO_PRECISION,
+                static_shapes=GROUNDING_DINO_STATIC_SHAPES,
+                compile_model=GROUNDING_DINO_COMPILE,
+                static_batch_size=DINO_BATCH_SIZE,
             )
             print(f'loaded Grouding DINO', self.GROUNDING_DINO_MODEL)
 
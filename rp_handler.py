@@ -1,9 +1,11 @@
 # rp_handler.py
 import runpod
+import asyncio
 import base64
 import io
 from model_config import KuberaModel
-from api_handler import detect_and_segment_object
+from settings import JOB_CONCURRENCY
+from api_handler import detect_and_segment_object, detect_and_segment_objects
 
 # Load segmentation model(s) on startup
 print("Loading Kubera segmentation models...")
@@ -19,6 +21,11 @@ def handler(event):
     print("Worker Start")
     input_data = event.get('input', {})
     image_data = input_data.get('image', None)  # Expecting a base64‑encoded image string
+    images_data = input_data.get('images', None)  # Or a list of base64‑encoded image strings
+    output_format = input_data.get('output_format', None)  # e.g. "webp" or {"format": "png", "compression": 1}
+
+    if images_data is not None:
+        return batch_handler(images_data, output_format)
 
     if not image_data:
         return {"error": "No image data received."}
@@ -33,7 +40,8 @@ def handler(event):
         result = detect_and_segment_object(
             image_input=image_io,
             grounding_dino_model=MODEL_OBJ.GROUNDING_DINO_MODEL,
-            sam_predictor=MODEL_OBJ.SAM_PREDICTOR
+            sam_predictor=MODEL_OBJ.SAM_PREDICTOR,
+            output_format=output_format
         )
         print("Segmentation complete.")
         return result
@@ -41,6 +49,50 @@ def handler(event):
         print("Error during processing:", str(e))
         return {"error": "Exception occurred", "details": str(e)}
 
+def batch_handler(images_data, output_format=None):
+    """Handles a list of base64 images, returning one result list (or error) per image."""
+    if not isinstance(images_data, list) or not images_data:
+        return {"error": "No image data received."}
+
+    # Decode each image on its own, so a malformed one only fails its own index
+    results = [None] * len(images_data)
+    image_ios = {}
+    for index, image_data in enumerate(images_data):
+        try:
+            image_ios[index] = io.BytesIO(base64.b64decode(image_data))
+        except Exception as e:
+            print(f"Error decoding image {index}:", str(e))
+            results[index] = {"error": "Exception occurred", "details": str(e)}
+
+    if not image_ios:
+        return results
+
+    try:
+        print(f"Running batch segmentation on {len(image_ios)} images...")
+        segmented = detect_and_segment_objects(
+            image_inputs=list(image_ios.values()),
+            grounding_dino_model=MODEL_OBJ.GROUNDING_DINO_MODEL,
+            sam_predictor=MODEL_OBJ.SAM_PREDICTOR,
+            output_format=output_format
+        )
+        for index, result in zip(image_ios, segmented):
+            results[index] = result
+        print("Batch segmentation complete.")
+        return results
+    except Exception as e:
+        print("Error during batch processing:", str(e))
+        return {"error": "Exception occurred", "details": str(e)}
+
+async def async_handler(event):
+    # Runs the blocking handler off the event loop so concurrent jobs share the pipeline
+    return await asyncio.to_thread(handler, event)
+
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    if JOB_CONCURRENCY > 1:
+        runpod.serverless.start({
+            "handler": async_handler,
+            "concurrency_modifier": lambda current_concurrency: JOB_CONCURRENCY,
+        })
+    else:
+        runpod.serverless.start({"handler": handler})
 
@@ -29,13 +29,67 @@ GROUNDING_DINO_CHECKPOINT_PATH = "weights/groundingdino_swint_ogc.pth"
 SAM_CHECKPOINT_PATH = "weights/sam_vit_h_4b8939.pth"
 # -----------------------------------------------
 
+# "fp32", or "bf16" / "fp16" autocast (bf16 for CPU-only workers). Keep fp32 until
+# GroundingDINO/demo/check_autocast_parity.py has passed on the production checkpoint.
+GROUNDING_DINO_PRECISION = "fp32"
+# pad inputs to a few fixed shapes and batches to DINO_BATCH_SIZE images (needed for GROUNDING_DINO_COMPILE)
+GROUNDING_DINO_STATIC_SHAPES = False
+GROUNDING_DINO_COMPILE = False  # torch.compile the backbone and transformer, slow first request per shape
+
 SAM_ENCODER_VERSION = "vit_h"
 SAM_DEVICE = "cuda"
+SAM_BOX_BATCH_SIZE = 16  # boxes decoded per SAM mask-decoder pass
+SAM_EMBEDDING_CACHE_BYTES = 512 * 1024 * 1024  # in-memory fp16 SAM embeddings (~2 MB each), 0 disables the cache
+SAM_EMBEDDING_SPILL_DIR = None  # directory evicted embeddings are spilled to, None keeps them in memory only
+SAM_EMBEDDING_SPILL_BYTES = 4 * 1024 * 1024 * 1024  # disk budget of the spill directory
+SAM_EMBEDDING_SPILL_QUEUE_SIZE = 16  # evicted embeddings waiting to be written before new ones are dropped
+
+# Batch settings
+DINO_BATCH_SIZE = 4  # images per GroundingDINO forward pass
+# If > 0, decode JPEGs at a reduced scale keeping the shorter side >= this (e.g. 1333). The
+# reduced image replaces the original everywhere, including the final crops: masks and output
+# objects come at the draft resolution (up to 8x smaller per side than the upload), not the
+# original one. Keep 0 when clients need full-resolution crops.
+INGEST_DRAFT_SIZE = 0
+
+# Pipeline settings (see api_handler.build_pipeline)
+# detect and segment hold stateful models (GroundingDINO features, SamPredictor image), keep them at 1
+PIPELINE_STAGE_WORKERS = {"ingest": 4, "detect": 1, "segment": 1, "encode": 2}
+PIPELINE_QUEUE_SIZE = 8  # pending items between two stages before upstream blocks
+# jobs a worker accepts at once. Requests only overlap in the pipeline (decode / encode of one
+# request during GPU work on another, cross-request GroundingDINO batches) when this is > 1;
+# at 1 runpod hands the worker one job at a time.
+# Trade-off: with > 1, images of concurrent requests share GroundingDINO batches and are padded
+# to the largest of them, and the Swin backbone sees that padding, so a request's boxes and
+# scores depend on which other requests arrive at the same time. GROUNDING_DINO_STATIC_SHAPES
+# narrows this to images of different 128-pixel shape buckets but does not remove it. Keep 1
+# for deterministic results, raise it only where throughput matters more.
+JOB_CONCURRENCY = 1
+
+# Output encoding settings (clients can override per request with "output_format")
+OUTPUT_FORMAT = "png"  # one of "png", "webp", "jpeg", "rle"
+PNG_COMPRESSION = 3  # 0-9, higher is smaller but much slower
+OUTPUT_QUALITY = 90  # WebP / JPEG quality
+ENCODE_WORKERS = 4  # threads slicing and encoding detections
+
+# Debug artifact settings (off in production; set DEBUG_ARTIFACTS=1 to enable)
+DEBUG_ARTIFACTS_ENABLED = os.environ.get("DEBUG_ARTIFACTS", "0") == "1"
+DEBUG_ARTIFACTS_DIR = "debug"
+DEBUG_ARTIFACTS_SAMPLE_RATE = 1.0  # fraction of images whose objects are saved
+DEBUG_ARTIFACTS_MAX_BYTES = 512 * 1024 * 1024  # stop writing once the directory holds this much
+DEBUG_ARTIFACTS_QUEUE_SIZE = 64  # pending writes before new artifacts are dropped
 
 # Threshold settings
 BOX_TRESHOLD = 0.35
 TEXT_TRESHOLD = 0.25
 
+# SAM gating: detections failing any of these are dropped before SAM runs, and the SAM
+# image encoder is skipped entirely when none survive. The defaults drop nothing that passes
+# BOX_TRESHOLD; raising any of them removes those detections from the response too.
+SAM_GATE_MIN_SCORE = BOX_TRESHOLD  # GroundingDINO box confidence
+SAM_GATE_MAX_BOXES = 0  # keep at most this many (highest scoring) boxes; 0 = no limit
+SAM_GATE_MIN_AREA = 0.0  # box area as a fraction of the image area
+
 # Object classes
 CLASSES = ["packet"]
 
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from api_handler import mask_to_rle
+
+mask_utils = pytest.importorskip("pycocotools.mask")
+
+
+def coco_rle(mask):
+    rle = mask_utils.encode(np.asfortranarray(mask.astype(np.uint8)))
+    return {"size": list(rle["size"]), "counts": rle["counts"].decode("ascii")}
+
+
+def check_matches_pycocotools(mask):
+    rle = mask_to_rle(mask)
+    assert rle == coco_rle(mask)
+    decoded = mask_utils.decode({"size": rle["size"], "counts": rle["counts"].encode("ascii")})
+    np.testing.assert_array_equal(decoded.astype(bool), mask)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("density", [0.02, 0.5, 0.98])
+def test_random_masks(seed, density):
+    rng = np.random.default_rng(seed)
+    h, w = rng.integers(1, 64, size=2)
+    check_matches_pycocotools(rng.random((h, w)) < density)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_random_blobs(seed):
+    # long runs, so the counts need several 5-bit groups and large deltas of either sign
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((300, 400), dtype=bool)
+    for _ in range(3):
+        y0, x0 = rng.integers(0, 250), rng.integers(0, 350)
+        mask[y0:y0 + rng.integers(1, 50), x0:x0 + rng.integers(1, 50)] = True
+    check_matches_pycocotools(mask)
+
+
+@pytest.mark.parametrize("mask", [
+    np.zeros((7, 5), dtype=bool),
+    np.ones((7, 5), dtype=bool),
+    np.eye(6, dtype=bool),  # starts with a 1
+    np.pad(np.ones((3, 3), dtype=bool), ((0, 4), (2, 2))),  # starts with a 1 in a later column
+    np.pad(np.ones((3, 3), dtype=bool), ((4, 0), (0, 0))),  # ends with a 1 in the last column
+    np.ones((1, 9), dtype=bool),
+    np.array([[0, 1, 1, 0, 0, 1, 0, 0, 0]], dtype=bool),
+    np.ones((9, 1), dtype=bool),
+    np.array([[1], [0], [0], [1], [1], [0], [1], [1], [1]], dtype=bool),
+    np.zeros((1, 1), dtype=bool),
+    np.ones((1, 1), dtype=bool),
+], ids=["empty", "full", "diagonal", "left-gap", "bottom-right", "1xN-full", "1xN", "Nx1-full", "Nx1",
+        "1x1-empty", "1x1-full"])
+def test_edge_cases(mask):
+    check_matches_pycocotools(mask)
+
+
+def test_uncompressed_counts():
+    mask = np.pad(np.ones((2, 2), dtype=bool), ((1, 0), (3, 1)))
+    rle = mask_to_rle(mask, compressed=False)
+    assert rle == {"size": [3, 6], "counts": [10, 2, 1, 2, 3]}
+    assert sum(rle["counts"]) == mask.size
@@ -0,0 +1,105 @@
+import os
+import queue
+import random
+import threading
+from settings import (
+    DEBUG_ARTIFACTS_ENABLED,
+    DEBUG_ARTIFACTS_DIR,
+    DEBUG_ARTIFACTS_SAMPLE_RATE,
+    DEBUG_ARTIFACTS_MAX_BYTES,
+    DEBUG_ARTIFACTS_QUEUE_SIZE,
+)
+
+
+class DebugArtifactSink:
+    """
+    Writes debug artifacts (encoded images, base64 strings) to disk from a background thread.
+
+    Requests only enqueue the bytes; if the queue is full, the image is not sampled,
+    or the directory already holds max_bytes, the artifact is dropped instead of
+    blocking the request.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = DEBUG_ARTIFACTS_ENABLED,
+        root_dir: str = DEBUG_ARTIFACTS_DIR,
+        sample_rate: float = DEBUG_ARTIFACTS_SAMPLE_RATE,
+        max_bytes: int = DEBUG_ARTIFACTS_MAX_BYTES,
+        queue_size: int = DEBUG_ARTIFACTS_QUEUE_SIZE,
+    ):
+        self.enabled = enabled
+        self.root_dir = root_dir
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def sample(self) -> bool:
+        """Decides whether the artifacts of the current image should be kept."""
+        return self.enabled and random.random() < self.sample_rate
+
+    def submit(self, relative_path: str, data: bytes) -> bool:
+        """Enqueues data to be written under root_dir. Returns False if it was dropped."""
+        if not self.enabled:
+            return False
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait((relative_path, data))
+            return True
+        except queue.Full:
+            print(f"WARN: Debug artifact queue full, dropping {relative_path}")
+            return False
+
+    def flush(self):
+        """Blocks until every queued artifact has been written or dropped."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="debug-artifact-sink", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        self.used_bytes = self._directory_size()
+        while True:
+            relative_path, data = self._queue.get()
+            try:
+                self._write(relative_path, data)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, relative_path: str, data: bytes):
+        path = os.path.join(self.root_dir, relative_path)
+        # an artifact replacing an existing file only adds the difference in size
+        try:
+            replaced_bytes = os.path.getsize(path)
+        except OSError:
+            replaced_bytes = 0
+        if self.used_bytes - replaced_bytes + len(data) > self.max_bytes:
+            print(f"WARN: Debug artifact disk cap ({self.max_bytes} bytes) reached, dropping {relative_path}")
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+            self.used_bytes += len(data) - replaced_bytes
+        except OSError as e:
+            print(f"WARN: Failed to save debug artifact {path}: {e}")
+
+    def _directory_size(self) -> int:
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return total
+
+
+DEBUG_SINK = DebugArtifactSink()
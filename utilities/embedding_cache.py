@@ -0,0 +1,195 @@
+import hashlib
+import os
+import queue
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+import torch
+from settings import (
+    SAM_EMBEDDING_CACHE_BYTES,
+    SAM_EMBEDDING_SPILL_DIR,
+    SAM_EMBEDDING_SPILL_BYTES,
+    SAM_EMBEDDING_SPILL_QUEUE_SIZE,
+)
+
+
+class CachedEmbedding(NamedTuple):
+    features: torch.Tensor  # fp16, on CPU
+    original_size: Tuple[int, int]
+    input_size: Tuple[int, int]
+
+    @property
+    def nbytes(self) -> int:
+        return self.features.numel() * self.features.element_size()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed LRU cache of SAM image embeddings.
+
+    Embeddings are stored in fp16 on the CPU and evicted least-recently-used once they
+    exceed max_bytes. If spill_dir is set, evicted entries are written there instead of
+    being discarded (up to spill_max_bytes) and promoted back to memory on a hit. Spills
+    are written by a background thread; an entry waiting to be written is still found by
+    get(). The cache never fails a request: errors reading or writing the spill directory
+    are logged and treated as a miss or a dropped entry.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = SAM_EMBEDDING_CACHE_BYTES,
+        spill_dir: Optional[str] = SAM_EMBEDDING_SPILL_DIR,
+        spill_max_bytes: int = SAM_EMBEDDING_SPILL_BYTES,
+        spill_queue_size: int = SAM_EMBEDDING_SPILL_QUEUE_SIZE,
+    ):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.used_bytes = 0
+        self.spilled_bytes = 0
+        self._entries = OrderedDict()
+        self._spilled = OrderedDict()  # key -> size on disk
+        self._pending = {}  # key -> entry evicted but not written to spill_dir yet
+        self._spill_queue = queue.Queue(maxsize=spill_queue_size)
+        self._spill_thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(image: np.ndarray, original_size: Tuple[int, int]) -> str:
+        """Hashes the encoder input together with the size the masks are mapped back to."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((image.shape, str(image.dtype), tuple(original_size))).encode("utf-8"))
+        digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[CachedEmbedding]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+            entry = self._pending.pop(key, None)
+            if entry is None:
+                if key not in self._spilled:
+                    return None
+                self.spilled_bytes -= self._spilled.pop(key)
+
+        if entry is None:
+            path = self._spill_path(key)
+            try:
+                entry = CachedEmbedding(*torch.load(path))
+            except Exception as e:
+                print(f"WARN: Failed to load spilled SAM embedding {path}: {e}")
+                return None
+            finally:
+                self._remove(path)
+        self.put(key, *entry)
+        return entry
+
+    def put(self, key: str, features: torch.Tensor, original_size, input_size):
+        if not self.enabled:
+            return
+        entry = CachedEmbedding(
+            features.detach().to("cpu", dtype=torch.float16), tuple(original_size), tuple(input_size)
+        )
+        if entry.nbytes > self.max_bytes:
+            return
+
+        evicted = []
+        with self._lock:
+            self._pending.pop(key, None)
+            if key in self._entries:
+                self.used_bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = entry
+            self.used_bytes += entry.nbytes
+            while self.used_bytes > self.max_bytes:
+                old_key, old_entry = self._entries.popitem(last=False)
+                self.used_bytes -= old_entry.nbytes
+                evicted.append((old_key, old_entry))
+
+        if self.spill_dir:
+            for old_key, old_entry in evicted:
+                self._queue_spill(old_key, old_entry)
+
+    def flush(self):
+        """Blocks until every queued spill has been written or dropped."""
+        if self._spill_thread is not None:
+            self._spill_queue.join()
+
+    def _queue_spill(self, key: str, entry: CachedEmbedding):
+        if entry.nbytes > self.spill_max_bytes:
+            return
+        with self._lock:
+            if self._spill_thread is None:
+                self._spill_thread = threading.Thread(target=self._run_spill, name="sam-embedding-spill", daemon=True)
+                self._spill_thread.start()
+            self._pending[key] = entry
+        try:
+            self._spill_queue.put_nowait(key)
+        except queue.Full:
+            print(f"WARN: SAM embedding spill queue full, dropping {key}")
+            with self._lock:
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+
+    def _run_spill(self):
+        while True:
+            key = self._spill_queue.get()
+            try:
+                with self._lock:
+                    entry = self._pending.get(key)
+                if entry is not None:
+                    self._spill(key, entry)
+            except Exception as e:
+                print(f"WARN: Failed to spill SAM embedding {key}: {e}")
+            finally:
+                self._spill_queue.task_done()
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, f"{key}.pt")
+
+    def _spill(self, key: str, entry: CachedEmbedding):
+        path = self._spill_path(key)
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            torch.save(tuple(entry), path)
+        except Exception as e:
+            # e.g. RuntimeError from the zip writer when the disk is full
+            print(f"WARN: Failed to spill SAM embedding to {path}: {e}")
+            with self._lock:
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+            self._remove(path)
+            return
+
+        stale = []
+        with self._lock:
+            if self._pending.get(key) is not entry:
+                # promoted back to memory (or replaced) while it was being written
+                stale.append(key)
+            else:
+                del self._pending[key]
+                self.spilled_bytes += entry.nbytes - self._spilled.pop(key, 0)
+                self._spilled[key] = entry.nbytes
+                while self.spilled_bytes > self.spill_max_bytes:
+                    old_key, old_size = self._spilled.popitem(last=False)
+                    self.spilled_bytes -= old_size
+                    stale.append(old_key)
+        for old_key in stale:
+            self._remove(self._spill_path(old_key))
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+SAM_EMBEDDING_CACHE = EmbeddingCache()
@@ -0,0 +1,97 @@
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, NamedTuple
+
+
+class Stage(NamedTuple):
+    name: str
+    fn: Callable
+    workers: int = 1
+    batch_size: int = 1  # > 1: fn receives a list of up to batch_size items and returns a list
+
+
+class StagedPipeline:
+    """
+    Runs items through a fixed sequence of stages, each served by its own worker threads.
+
+    Stages are connected by bounded queues, so a slow stage applies backpressure upstream
+    while the other stages keep working on neighbouring items (e.g. CPU decode of the next
+    image overlaps GPU inference of the current one). submit() returns a Future that
+    resolves to the output of the last stage, or to the exception raised by any stage.
+    If a batched stage fails, its items are retried one at a time, so that only the
+    futures of the items that fail on their own get the exception.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 8):
+        self.stages = stages
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._threads = []
+        for index, stage in enumerate(stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._run, args=(index,), name=f"pipeline-{stage.name}-{worker}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, item) -> Future:
+        """Enqueues an item at the first stage, blocking while that stage's queue is full."""
+        future = Future()
+        self._queues[0].put((item, future))
+        return future
+
+    def _next_batch(self, index: int) -> list:
+        stage_queue = self._queues[index]
+        batch = [stage_queue.get()]
+        while len(batch) < self.stages[index].batch_size:
+            try:
+                batch.append(stage_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, index: int):
+        stage = self.stages[index]
+        while True:
+            batch = self._next_batch(index)
+            if index == 0:
+                # drop items whose caller cancelled the future while they were queued
+                batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+                if not batch:
+                    continue
+            # callers wait on the futures without a timeout, so every future of the batch
+            # must be resolved or handed to the next stage, whatever happens here
+            undispatched = [future for _, future in batch]
+            try:
+                for (result, error), future in zip(self._call(stage, batch), list(undispatched)):
+                    if error is not None:
+                        future.set_exception(error)
+                    elif index + 1 < len(self.stages):
+                        self._queues[index + 1].put((result, future))
+                    else:
+                        future.set_result(result)
+                    undispatched.remove(future)
+            except BaseException as e:
+                print(f"ERROR: Pipeline stage '{stage.name}' failed to dispatch its results: {e}")
+                for future in undispatched:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _call(self, stage: Stage, batch: list) -> list:
+        # Returns one (result, exception) pair per item of batch. BaseException is caught as
+        # well, so that e.g. a SystemExit raised by fn fails its items instead of killing the
+        # stage's worker thread and leaving every later item unresolved.
+        try:
+            if stage.batch_size > 1:
+                results = list(stage.fn([item for item, _ in batch]))
+                if len(results) != len(batch):
+                    raise RuntimeError(f"returned {len(results)} results for {len(batch)} items")
+                return [(result, None) for result in results]
+            return [(stage.fn(batch[0][0]), None)]
+        except BaseException as e:
+            if len(batch) == 1:
+                print(f"ERROR: Pipeline stage '{stage.name}' failed: {e}")
+                return [(None, e)]
+            print(f"WARN: Pipeline stage '{stage.name}' failed on a batch of {len(batch)}, retrying one at a time: {e}")
+            return [self._call(stage, [entry])[0] for entry in batch]